@@ -9,18 +9,54 @@ import re
 import subprocess
 import shutil
 import time
+import threading
+import itertools
+from array import array
 from blackduck.HubRestApi import HubInstance
 
 def check_args():
     global args
     global do_upload
 
+    if args.kb_compact_output != "":
+        return True
+
+    if len(args.kb_gap) > 0:
+        for path in args.kb_gap:
+            if not os.path.exists(path):
+                print("KB gap manifest file or folder '{}' does not exist\nExiting".format(path))
+                return False
+        if args.replacefile != "" and not os.path.isfile(args.replacefile):
+            print("Replacefile file '{}' does not exist\nExiting".format(args.replacefile))
+            return False
+        return True
+
+    if args.fleet != "":
+        if not os.path.isfile(args.fleet):
+            print("Fleet file '{}' does not exist\nExiting".format(args.fleet))
+            return False
+        if args.project != "" or args.version != "" or args.cve_check_file != "" or args.manifest != "" or \
+                args.buildhistory != "" or args.output_json != "" or args.watch or args.no_cve_check:
+            print("Option --fleet cannot be used with -p, -v, --cve_check_file, --manifest, --buildhistory, "
+                  "--output_json, --watch or --no_cve_check")
+            return False
+        if args.fleet_workers < 1:
+            print("Option --fleet_workers must be 1 or more")
+            return False
+        return True
+
     if args.project != "" and args.version != "":
         pass
     else:
         print("Please specify Black Duck project/version using -p and -v\nExiting")
         return False
 
+    if args.state_report or args.state_diff != "":
+        if args.no_state:
+            print("Options --state_report and --state_diff cannot be used with --no_state")
+            return False
+        return True
+
     if not os.path.isdir(args.yocto_build_folder):
         print("Specified Yocto build folder '{}' does not exist\nExiting".format(args.yocto_build_folder))
         return False
@@ -48,6 +84,24 @@ def check_args():
         print("Manifest file '{}' does not exist\nExiting".format(args.manifest))
         return False
 
+    if args.buildhistory != "" and not os.path.isdir(os.path.join(args.buildhistory, "packages")):
+        print("Buildhistory folder '{}' does not exist or has no packages folder\nExiting".format(args.buildhistory))
+        return False
+
+    if args.buildhistory != "" and args.manifest != "":
+        print("Options --buildhistory and --manifest cannot be specified together")
+        return False
+
+    if args.watch and (args.manifest != "" or args.cve_check_file != "" or args.output_json != "" or
+                       args.cve_check_only or args.buildhistory != "" or args.debug):
+        print("Option --watch cannot be used with --manifest, --cve_check_file, --output_json, --cve_check_only, "
+              "--buildhistory or --debug")
+        return False
+
+    if args.watch and args.watch_workers < 1:
+        print("Option --watch_workers must be 1 or more")
+        return False
+
     if args.replacefile != "" and not os.path.isfile(args.replacefile):
         print("Replacefile file '{}' does not exist\nExiting".format(args.replacefile))
         return False
@@ -57,7 +111,8 @@ def check_args():
 
 def check_env():
     global args
-    if args.debug:
+    if args.debug or args.buildhistory != "" or args.fleet != "" or args.state_report or args.state_diff != "" or \
+            args.kb_compact_output != "" or (len(args.kb_gap) > 0 and args.show_recipes_file != ""):
         return True
     if platform.system() != "Linux":
         print("Please use this program on a Linux platform where Yocto project has been built\nExiting")
@@ -101,9 +156,14 @@ def check_yocto_build_folder():
 
 
 def find_files():
-    global args, licdir, args
+    global args, licdir, deploy_dir
 
-    if args.debug:
+    if args.debug or args.fleet != "" or args.state_report or args.state_diff != "" or args.kb_compact_output != "" or \
+            len(args.kb_gap) > 0:
+        return True
+
+    if args.buildhistory != "" and (args.cve_check_file != "" or args.no_cve_check or args.cve_check_only):
+        # Build folder not required
         return True
 
     # Locate yocto files & folders
@@ -173,21 +233,31 @@ def find_files():
     if args.arch == "":
         args.arch = machine.strip('"')
 
+    deploy_dir = deploydir
+    if args.watch:
+        # Manifest and CVE files are located as builds complete
+        return True
+
     licdir = os.path.join(deploydir, "licenses")
-    if args.manifest == "":
-        manifestdir = ""
+    if args.manifest == "" and args.buildhistory == "":
         if not os.path.isdir(licdir):
             print("License directory {} does not exist - has Yocto project been built?".format(licdir))
             return False
-        for file in sorted(os.listdir(licdir)):
-            if file.startswith(args.target + "-" + args.arch + "-"):
-                manifestdir = os.path.join(licdir, file)
 
-        manifestfile = os.path.join(manifestdir, "license.manifest")
-        if not os.path.isfile(manifestfile):
+    if args.manifest != "" and (args.cve_check_file != "" or args.no_cve_check):
+        # Nothing to locate in the deploy folder
+        return True
+
+    if not load_deploy_index(deploydir):
+        return False
+    image = args.target + "-" + args.arch
+
+    if args.manifest == "" and args.buildhistory == "":
+        manifestfile = latest_deploy_file('manifests', image)
+        if manifestfile == "" or not os.path.isfile(manifestfile):
             print(
-                "Build manifest file {} does not exist - either build Yocto project or use -m option to specify build manifest file\nExiting".format(
-                    manifestfile))
+                "Build manifest file for {} does not exist - either build Yocto project or use -m option to specify build manifest file\nExiting".format(
+                    image))
             return False
         else:
             print("Located manifest file {}".format(manifestfile))
@@ -195,13 +265,9 @@ def find_files():
         args.manifest = manifestfile
 
     if args.cve_check_file == "" and not args.no_cve_check:
-        imgdir = os.path.join(deploydir, "images", args.arch)
-        cvefile = ""
-        for file in sorted(os.listdir(imgdir)):
-            if file.startswith(args.target + "-" + args.arch + "-") and file.endswith("rootfs.cve"):
-                cvefile = os.path.join(imgdir, file)
+        cvefile = latest_deploy_file('cvefiles', image)
 
-        if not os.path.isfile(cvefile):
+        if cvefile == "" or not os.path.isfile(cvefile):
             print("WARNING: CVE check file could not be located - CVE patch updates will be skipped")
         else:
             print("Located CVE check output file {}".format(cvefile))
@@ -210,33 +276,377 @@ def find_files():
     return True
 
 
-def proc_license_manifest(liclines):
+# Forge metadata shared by every yocto component - must not be modified
+YOCTO_FORGE = {
+    "name": "yocto",
+    "separator": "/",
+    "usePreferredNamespaceAlias": True
+}
+
+
+class Recipe:
+    __slots__ = ('name', 'version', 'orig_version', 'revision', 'layer', 'component', 'outcome')
+
+    def __init__(self, name, version):
+        self.name = sys.intern(name)
+        self.version = version
+        self.orig_version = version
+        self.revision = ""
+        self.layer = ""
+        self.component = None
+        self.outcome = "NOTCHECKED"
+
+
+class Component:
+    # Yocto recipe component - converted to BDIO JSON only when the BDIO file is written
+    __slots__ = ('layer', 'recipever')
+
+    def __init__(self, layer, recipever):
+        self.layer = sys.intern(layer)
+        self.recipever = recipever
+
+    def get_id(self):
+        return "http:yocto/" + self.layer + "/" + self.recipever
+
+    def relationship(self):
+        return {
+            "related": self.get_id(),
+            "relationshipType": "DYNAMIC_LINK"
+        }
+
+    def to_bdio(self):
+        return {
+            "@id": self.get_id(),
+            "@type": "Component",
+            "externalIdentifier": {
+                "externalSystemTypeId": "@yocto",
+                "externalId": self.layer + "/" + self.recipever,
+                "externalIdMetaData": {
+                    "forge": YOCTO_FORGE,
+                    "pieces": [
+                        self.recipever.replace("/", ",")
+                    ],
+                    "prefix": self.layer
+                }
+            },
+            "relationship": []
+        }
+
+    def dependency(self):
+        return {
+            "@type": "Dependency",
+            "dependsOn": self.get_id()
+        }
+
+    def to_bdio2(self):
+        # Replaced recipes may not specify a version
+        arr = self.recipever.split("/", 1)
+        comp = {
+            "@id": self.get_id(),
+            "@type": "Component",
+            "namespace": "yocto",
+            "identifier": self.layer + "/" + self.recipever,
+            "name": arr[0]
+        }
+        if len(arr) > 1:
+            comp["version"] = arr[1]
+        return comp
+
+
+class LayerComponent(Component):
+    # Yocto layer component linking to the recipe components within the layer
+    __slots__ = ('recipe_comps',)
+
+    def __init__(self, layer, recipe_comps):
+        Component.__init__(self, layer, "1.0")
+        self.recipe_comps = recipe_comps
+
+    def to_bdio(self):
+        return {
+            "@id": self.get_id(),
+            "@type": "Component",
+            "externalIdentifier": {
+                "externalSystemTypeId": "@yocto",
+                "externalId": self.layer,
+                "externalIdMetaData": {
+                    "forge": YOCTO_FORGE,
+                    "pieces": [
+                        self.layer,
+                        "1.0"
+                    ],
+                    "prefix": "meta"
+                }
+            },
+            "relationship": [comp.relationship() for comp in self.recipe_comps]
+        }
+
+    def to_bdio2(self):
+        return {
+            "@id": self.get_id(),
+            "@type": "Component",
+            "namespace": "yocto",
+            "identifier": self.layer,
+            "name": self.layer,
+            "version": "1.0",
+            "dependency": [comp.dependency() for comp in self.recipe_comps]
+        }
+
+
+def bdio_default(obj):
+    # json.dumps() hook to serialize Component objects within the BDIO
+    return obj.to_bdio()
+
+
+def bdio2_default(obj):
+    return obj.to_bdio2()
+
+
+def deploy_dir_mtimes(deploydir):
+    # Modification times of the deploy folders which are indexed (used to detect changes)
+    mtimes = {}
+    licdir = os.path.join(deploydir, "licenses")
+    if os.path.isdir(licdir):
+        mtimes[licdir] = os.stat(licdir).st_mtime
+    imgroot = os.path.join(deploydir, "images")
+    if os.path.isdir(imgroot):
+        for entry in os.scandir(imgroot):
+            if entry.is_dir():
+                mtimes[entry.path] = entry.stat().st_mtime
+    return mtimes
+
+
+DEPLOY_INDEX_FORMAT = 2
+
+
+def index_deploy_dir(deploydir):
+    # Index image manifests, cve_check files and recipeinfo folders in the deploy folder in one pass
+    # (manifests and cvefiles are lists of [mtime, <image>-<machine>-<suffix> name, path])
+    index = {
+        'format': DEPLOY_INDEX_FORMAT,
+        'deploydir': deploydir,
+        'mtimes': deploy_dir_mtimes(deploydir),
+        'machines': [],
+        'manifests': [],
+        'cvefiles': [],
+        'recipeinfo': [],
+    }
+
+    licdir = os.path.join(deploydir, "licenses")
+    if os.path.isdir(licdir):
+        for entry in os.scandir(licdir):
+            if not entry.is_dir():
+                continue
+            manifest = os.path.join(entry.path, "license.manifest")
+            if os.path.isfile(manifest):
+                # <image>-<machine>-<IMAGE_VERSION_SUFFIX>
+                index['manifests'].append([entry.stat().st_mtime, entry.name, manifest])
+            else:
+                index['recipeinfo'].append(entry.name)
+
+    imgroot = os.path.join(deploydir, "images")
+    if os.path.isdir(imgroot):
+        for machine in os.scandir(imgroot):
+            if not machine.is_dir():
+                continue
+            index['machines'].append(machine.name)
+            for entry in os.scandir(machine.path):
+                # <image>-<machine>-<IMAGE_VERSION_SUFFIX>.rootfs.cve (not the <image>-<machine>.rootfs.cve link)
+                if entry.name.endswith(".rootfs.cve") and not entry.is_symlink():
+                    index['cvefiles'].append([entry.stat().st_mtime, entry.name[:-len(".rootfs.cve")], entry.path])
+
+    return index
+
+
+def deploy_image_suffix(name, image, machines):
+    # Return the suffix of a deploy entry named <image>-<suffix> for image <target>-<machine> ("" if the entry is
+    # not for the image, including images for other machines extending the machine name, e.g. qemux86-64)
+    global args
+
+    if not name.startswith(image + "-") or len(name) == len(image) + 1:
+        return ""
+    for machine in machines:
+        if machine.startswith(args.arch + "-") and name.startswith(args.target + "-" + machine + "-"):
+            return ""
+    return name[len(image) + 1:]
+
+
+def load_deploy_index(deploydir):
+    # Load the persisted deploy folder index if the deploy folders are unchanged, otherwise rebuild it
+    # (persisting the index is best-effort - the in-memory index is used if the cache cannot be read or written)
+    global deploy_index
+    import hashlib
+
+    indexfile = ""
+    try:
+        indexfile = os.path.join(get_cache_dir(),
+                                 "deploy_" + hashlib.sha1(deploydir.encode()).hexdigest()[:16] + ".json")
+        if os.path.isfile(indexfile):
+            i = open(indexfile, "r")
+            index = json.load(i)
+            i.close()
+            if index.get('format') == DEPLOY_INDEX_FORMAT and index.get('deploydir') == deploydir and \
+                    index.get('mtimes') == deploy_dir_mtimes(deploydir):
+                deploy_index = index
+                return True
+    except Exception as e:
+        print("WARNING: Unable to load cached deploy folder index - rebuilding\n" + str(e))
+
+    try:
+        deploy_index = index_deploy_dir(deploydir)
+    except Exception as e:
+        print("ERROR: Unable to index deploy folder {}\n".format(deploydir) + str(e))
+        return False
+
+    if indexfile != "":
+        try:
+            i = open(indexfile + ".tmp", "w")
+            json.dump(deploy_index, i)
+            i.close()
+            os.replace(indexfile + ".tmp", indexfile)
+        except Exception as e:
+            print("WARNING: Unable to save deploy folder index {}\n".format(indexfile) + str(e))
+    return True
+
+
+def latest_deploy_file(filetype, image):
+    # Return latest (by modification time) file of type 'manifests' or 'cvefiles' for <image>-<machine>
+    global deploy_index
+
+    entries = [entry for entry in deploy_index[filetype]
+               if deploy_image_suffix(entry[1], image, deploy_index['machines']) != ""]
+    if len(entries) == 0:
+        return ""
+    return max(entries)[2]
+
+
+UPLOAD_THREADS = 4
+GOVERNOR_INITIAL_LIMIT = 2
+GOVERNOR_RETRIES = 5
+# Watch mode - seconds without further changes before importing a build, polling interval and
+# maximum wait for license.manifest after the first event for a build
+WATCH_DEBOUNCE = 10
+WATCH_POLL_INTERVAL = 15
+WATCH_MANIFEST_TIMEOUT = 600
+VULN_THREADS = 8
+# Query patched CVEs individually if there are fewer than 1/PER_CVE_QUERY_RATIO of the vulnerable components
+PER_CVE_QUERY_RATIO = 4
+ACTIONABLE_STATUSES = ['NEW', 'NEEDS_REVIEW', 'REMEDIATION_REQUIRED']
+
+
+COMPRESSION_MAGIC = [
+    (b"\x1f\x8b", 'gzip'),
+    (b"\xfd7zXZ\x00", 'xz'),
+    (b"BZh", 'bzip2'),
+    (b"\x28\xb5\x2f\xfd", 'zstd'),
+]
+
+
+def input_compression(path):
+    # Compression format of input file from its magic bytes ("" if not compressed)
+    f = open(path, "rb")
+    magic = f.read(6)
+    f.close()
+    for prefix, name in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            return name
+    return ""
+
+
+def open_input(path, text=True):
+    # Open input file for streaming read, transparently decompressing gzip, xz, bzip2 or zstd files
+    # (zstd requires the zstandard module)
+    import io
+
+    compression = input_compression(path)
+    f = open(path, "rb")
+    if compression == 'gzip':
+        import gzip
+        f = gzip.GzipFile(fileobj=f)
+    elif compression == 'xz':
+        import lzma
+        f = lzma.LZMAFile(f)
+    elif compression == 'bzip2':
+        import bz2
+        f = bz2.BZ2File(f)
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            f.close()
+            raise OSError("zstandard module is required to read zstd compressed file {} "
+                          "(pip3 install zstandard)".format(path))
+        f = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f, closefd=True))
+
+    if text:
+        return io.TextIOWrapper(f, encoding="utf-8", errors="replace")
+    return f
+
+
+def open_manifest_records(manifest):
+    # Open license.manifest file (optionally compressed) and return a generator of
+    # (package, version, recipe) records - uncompressed files are memory mapped
+    import mmap
+
+    if input_compression(manifest) != "":
+        return manifest_records(open_input(manifest, text=False))
+
+    f = open(manifest, "rb")
+    if os.fstat(f.fileno()).st_size == 0:
+        return manifest_records(f)
+    return manifest_records(f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def manifest_records(f, m=None):
+    if m is not None:
+        lines = iter(m.readline, b"")
+    else:
+        lines = f
+
+    package = ""
+    ver = ""
+    try:
+        for line in lines:
+            arr = line.split(b":")
+            if len(arr) > 1:
+                key = arr[0]
+                if key == b"PACKAGE NAME":
+                    package = arr[1].strip().decode("utf-8", "replace")
+                elif key == b"PACKAGE VERSION":
+                    ver = arr[1].strip().decode("utf-8", "replace")
+                elif key == b"RECIPE NAME":
+                    yield package, ver, arr[1].strip().decode("utf-8", "replace")
+    finally:
+        if m is not None:
+            m.close()
+        f.close()
+
+
+def proc_license_manifest(records):
     global recipes, packages
 
     print("- Working on recipes from license.manifest: ...")
     entries = 0
-    ver = ''
-    for line in liclines:
-        arr = line.split(":")
-        if len(arr) > 1:
-            key = arr[0]
-            value = arr[1].strip()
-            if key == "PACKAGE NAME":
-                packages.append(value)
-            elif key == "PACKAGE VERSION":
-                ver = value
-            elif key == "RECIPE NAME":
-                entries += 1
-                if value not in recipes.keys():
-                    recipes[value] = ver
+    for package, ver, recipe in records:
+        packages.add(package)
+        entries += 1
+        if recipe not in recipes.keys():
+            recipes[recipe] = Recipe(recipe, ver)
     if entries == 0:
         return False
     print("	Identified {} recipes from {} packages".format(len(recipes), entries))
     return True
 
 
-def proc_layers_in_recipes():
-    global layers, recipe_layer, args
+def bitbake_show_recipes():
+    # Return bitbake-layers show-recipes output lines
+    output = subprocess.check_output(['bitbake-layers', 'show-recipes', '*'], stderr=subprocess.STDOUT)
+    mystr = output.decode("utf-8").strip()
+    return mystr.splitlines()
+
+
+def read_layer_recipes():
+    # Return dict of recipe: (layer, version) and list of layers from bitbake-layers show-recipes output
+    global args
 
     if args.debug:
         if not os.path.isfile('DEBUG_bblayers.txt'):
@@ -245,12 +655,21 @@ def proc_layers_in_recipes():
         r = open('DEBUG_bblayers.txt', "r")
         lines = r.read().splitlines()
         r.close()
+    elif args.show_recipes_file != "":
+        print("- Identifying layers for recipes from {} ...".format(args.show_recipes_file))
+        try:
+            r = open(args.show_recipes_file, "r")
+            lines = r.read().splitlines()
+            r.close()
+        except Exception as e:
+            print("ERROR: Unable to read show-recipes file {}\n".format(args.show_recipes_file) + str(e))
+            sys.exit(3)
     else:
         print("- Identifying layers for recipes ...")
-        output = subprocess.check_output(['bitbake-layers', 'show-recipes', '*'], stderr=subprocess.STDOUT)
-        mystr = output.decode("utf-8").strip()
-        lines = mystr.splitlines()
+        lines = bitbake_show_recipes()
 
+    recipe_layers = {}
+    found_layers = []
     rec = ""
     bstart = False
     for rline in lines:
@@ -261,217 +680,649 @@ def proc_layers_in_recipes():
             elif rec != "":
                 arr = rline.split()
                 if len(arr) > 1:
-                    layer = arr[0]
-                    ver = arr[1]
-                    recipe_layer[rec] = layer
-                    if rec in recipes.keys():
-                        recipes[rec] = ver
-                    if layer not in layers:
-                        layers.append(layer)
+                    layer = sys.intern(arr[0])
+                    recipe_layers[rec] = (layer, arr[1])
+                    if layer not in found_layers:
+                        found_layers.append(layer)
                 rec = ""
         elif rline.endswith(" recipes: ==="):
             bstart = True
+    return recipe_layers, found_layers
+
+
+def proc_layers_in_recipes():
+    global layers, recipes
+
+    recipe_layers, found_layers = read_layer_recipes()
+    for recipe, (layer, ver) in recipe_layers.items():
+        if recipe in recipes.keys():
+            recipes[recipe].layer = layer
+            recipes[recipe].version = ver
+    for layer in found_layers:
+        if layer not in layers:
+            layers.append(layer)
+    print("	Discovered {} layers".format(len(layers)))
+
+
+def find_buildhistory_image(bhdir):
+    # Locate installed-package-names.txt for the target image in buildhistory/images/<machine>/<libc>/<image>
+    # (machine folders use MACHINE_ARCH, e.g. qemux86_64 for qemux86-64)
+    global args
+
+    found = []
+    imgroot = os.path.join(bhdir, "images")
+    machines = []
+    if os.path.isdir(imgroot):
+        machines = sorted(os.listdir(imgroot))
+    for machine in machines:
+        if args.arch != "" and machine.replace("-", "_") != args.arch.replace("-", "_"):
+            continue
+        machinedir = os.path.join(imgroot, machine)
+        if not os.path.isdir(machinedir):
+            continue
+        for libc in sorted(os.listdir(machinedir)):
+            pkgfile = os.path.join(machinedir, libc, args.target, "installed-package-names.txt")
+            if os.path.isfile(pkgfile):
+                found.append(pkgfile)
+                break
+    if len(found) > 1:
+        print("ERROR: Image {} exists for several machines in buildhistory - use --arch to select the machine".format(
+            args.target))
+        return ""
+    if len(found) == 0:
+        print("ERROR: Cannot locate installed-package-names.txt for image {} in buildhistory".format(args.target))
+        return ""
+    return found[0]
+
+
+def buildhistory_package_archs(pkgfile):
+    # Return package architectures of the image packages from installed-packages.txt (ipk or rpm file names),
+    # or an empty list if they cannot be determined
+    archs = set()
+    listfile = os.path.join(os.path.dirname(pkgfile), "installed-packages.txt")
+    if not os.path.isfile(listfile):
+        return []
+    p = open(listfile, "r")
+    for line in p:
+        name = os.path.basename(line.strip())
+        if name.endswith(".ipk"):
+            # <name>_<version>_<arch>.ipk
+            archs.add(name[:-4].split("_")[-1])
+        elif name.endswith(".rpm"):
+            # <name>-<version>-<release>.<arch>.rpm
+            archs.add(name[:-4].split(".")[-1])
+        elif name != "":
+            p.close()
+            return []
+    p.close()
+    return sorted(arch.replace("_", "-") for arch in archs)
+
+
+def buildhistory_arch_dir_selected(archdir, archs):
+    # Package arch folders are named <arch>-<vendor>-<os> (e.g. core2-64-poky-linux)
+    if len(archs) == 0:
+        return True
+    name = archdir.replace("_", "-")
+    return any(name.startswith(arch + "-") for arch in archs)
+
+
+def read_buildhistory_vars(latest):
+    # Read 'VAR = value' lines from buildhistory latest file
+    bhvars = {}
+    b = open(latest, "r")
+    for line in b:
+        arr = line.split(" = ", 1)
+        if len(arr) == 2:
+            bhvars[arr[0].strip()] = arr[1].strip()
+    b.close()
+    return bhvars
+
+
+def find_bblayers_conf(bhdir):
+    # Locate bblayers.conf in the Yocto build folder or the build folder containing buildhistory
+    global args
+
+    if args.bblayers != "":
+        return args.bblayers
+    for builddir in [args.yocto_build_folder, os.path.join(args.yocto_build_folder, "build"),
+                     os.path.join(bhdir, "..")]:
+        conffile = os.path.join(builddir, "conf", "bblayers.conf")
+        if os.path.isfile(conffile):
+            return conffile
+    return ""
+
+
+def read_conf_values(conffile, var):
+    # Return values assigned or appended to a variable in a bitbake conf file (joining continuation lines)
+    import re
+
+    c = open(conffile, "r")
+    text = c.read().replace("\\\n", " ")
+    c.close()
+    values = []
+    for match in re.finditer(r'^\s*' + re.escape(var) + r'\s*(?:\?\?=|\?=|\+=|=\+|:=|=)\s*"([^"]*)"', text,
+                             re.MULTILINE):
+        values += match.group(1).split()
+    return values
+
+
+def read_layer_collections(bhdir):
+    # Return dict of BBFILE_COLLECTIONS name: layer folder name for the layers in bblayers.conf
+    # (buildhistory records the collection name, the KB and bitbake-layers use the layer folder name)
+    conffile = find_bblayers_conf(bhdir)
+    if conffile == "" or not os.path.isfile(conffile):
+        print("WARNING: Cannot locate bblayers.conf - buildhistory layer collection names will be used as layers "
+              "(use --bblayers to specify)")
+        return {}
+
+    topdir = os.path.dirname(os.path.dirname(os.path.abspath(conffile)))
+    collections = {}
+    try:
+        for layerdir in read_conf_values(conffile, 'BBLAYERS'):
+            layerdir = os.path.expandvars(layerdir.replace('${TOPDIR}', topdir))
+            layerconf = os.path.join(layerdir, "conf", "layer.conf")
+            if not os.path.isfile(layerconf):
+                print("WARNING: Cannot read layer config file {}".format(layerconf))
+                continue
+            for collection in read_conf_values(layerconf, 'BBFILE_COLLECTIONS'):
+                collections[collection] = os.path.basename(os.path.normpath(layerdir))
+    except Exception as e:
+        print("WARNING: Unable to read bblayers.conf file {}\n".format(conffile) + str(e))
+    return collections
+
+
+def proc_buildhistory(bhdir):
+    # Identify recipes, versions, revisions and layers for the image packages from buildhistory in a single pass
+    # (replaces license.manifest, bitbake-layers and recipeinfo processing)
+    global recipes, packages, layers
+
+    print("- Working on recipes from buildhistory {}: ...".format(bhdir))
+    collections = read_layer_collections(bhdir)
+    unmapped = set()
+    pkgfile = find_buildhistory_image(bhdir)
+    if pkgfile == "":
+        return False
+
+    try:
+        p = open(pkgfile, "r")
+        image_pkgs = set(line.strip() for line in p if line.strip() != "")
+        p.close()
+
+        archs = buildhistory_package_archs(pkgfile)
+        if len(archs) == 0:
+            print("WARNING: Unable to determine package architectures of image {} - all buildhistory package "
+                  "architectures will be used".format(args.target))
+
+        entries = 0
+        for archentry in os.scandir(os.path.join(bhdir, "packages")):
+            if not archentry.is_dir() or not buildhistory_arch_dir_selected(archentry.name, archs):
+                continue
+            for recentry in os.scandir(archentry.path):
+                latest = os.path.join(recentry.path, "latest")
+                if not recentry.is_dir() or not os.path.isfile(latest):
+                    continue
+                bhvars = read_buildhistory_vars(latest)
+                found = []
+                for pkg in bhvars.get('PACKAGES', '').split():
+                    if pkg not in image_pkgs:
+                        # Check for renamed package (e.g. debian package naming)
+                        pkglatest = os.path.join(recentry.path, pkg, "latest")
+                        if not os.path.isfile(pkglatest):
+                            continue
+                        pkg = read_buildhistory_vars(pkglatest).get('PKG', pkg)
+                    if pkg in image_pkgs:
+                        found.append(pkg)
+                if len(found) == 0:
+                    continue
+
+                packages.update(found)
+                entries += len(found)
+                if recentry.name not in recipes.keys():
+                    ver = bhvars.get('PV', '')
+                    if bhvars.get('PE', '') not in ['', '0']:
+                        ver = bhvars['PE'] + ":" + ver
+                    rec = Recipe(recentry.name, ver)
+                    rec.revision = bhvars.get('PR', '')
+                    collection = bhvars.get('LAYER', '')
+                    if collection in collections:
+                        rec.layer = sys.intern(collections[collection])
+                    else:
+                        rec.layer = sys.intern(collection)
+                        if collection != "" and len(collections) > 0:
+                            unmapped.add(collection)
+                    if rec.layer != "" and rec.layer not in layers:
+                        layers.append(rec.layer)
+                    recipes[recentry.name] = rec
+    except Exception as e:
+        print("ERROR: Unable to read buildhistory folder {}\n".format(bhdir) + str(e))
+        return False
+
+    if entries == 0:
+        return False
+    if len(unmapped) > 0:
+        print("WARNING: Layer collections {} not found in bblayers.conf".format(",".join(sorted(unmapped))))
+    print("	Identified {} recipes from {} packages".format(len(recipes), entries))
     print("	Discovered {} layers".format(len(layers)))
+    return True
+
+
+def normalise_recipe_version(rec):
+    if rec.version.find("AUTOINC") != -1:
+        # rec.version = rec.version.split("AUTOINC")[0] + "X-" + rec.version.split("-")[-1]
+        rec.version = rec.version.split("AUTOINC")[0] + "X"
+    if rec.version.find("+svn") != -1:
+        # rec.version = rec.version.split("+svn")[0] + "+svnX" + rec.version.split("-")[-1]
+        rec.version = rec.version.split("+svn")[0] + "+svnX"
+
+
+def recipeinfo_revisions(recipeinfo):
+    # Return list of PR values from recipeinfo file
+    r = open(recipeinfo, "r")
+    reclines = r.readlines()
+    r.close()
+    revs = []
+    for line in reclines:
+        if line.find("PR:") != -1:
+            arr = line.split(":")
+            revs.append(arr[1].strip())
+    return revs
 
 
 def proc_recipe_revisions():
-    global licdir, recipes, args, orig_recipes
+    global licdir, recipes, args, deploy_index
 
-    orig_recipes = recipes
     print("- Identifying recipe revisions: ...")
-    for recipe in recipes.keys():
-        if recipes[recipe].find("AUTOINC") != -1:
-            # recipes[recipe] = recipes[recipe].split("AUTOINC")[0] + "X-" + recipes[recipe].split("-")[-1]
-            recipes[recipe] = recipes[recipe].split("AUTOINC")[0] + "X"
-        if recipes[recipe].find("+svn") != -1:
-            # recipes[recipe] = recipes[recipe].split("+svn")[0] + "+svnX" + recipes[recipe].split("-")[-1]
-            recipes[recipe] = recipes[recipe].split("+svn")[0] + "+svnX"
+    if deploy_index is not None:
+        recipeinfo_dirs = set(deploy_index['recipeinfo'])
+    elif os.path.isdir(licdir):
+        recipeinfo_dirs = set(os.listdir(licdir))
+    else:
+        recipeinfo_dirs = set()
+    for recipe, rec in recipes.items():
+        normalise_recipe_version(rec)
+        if rec.revision != "":
+            # Revision already known from buildhistory
+            rec.version += "-" + rec.revision
+            rec.orig_version = rec.version
+            continue
         if args.debug:
-            recipes[recipe] += "-r0"
+            rec.version += "-r0"
+            rec.orig_version = rec.version
             continue
 
         recipeinfo = os.path.join(licdir, recipe, "recipeinfo")
-        if os.path.isfile(recipeinfo):
+        if recipe in recipeinfo_dirs:
             try:
-                r = open(recipeinfo, "r")
-                reclines = r.readlines()
-                r.close()
+                revs = recipeinfo_revisions(recipeinfo)
             except Exception as e:
                 print("ERROR: unable to open recipeinfo file {}\n".format(recipeinfo) + str(e))
                 sys.exit(3)
-            for line in reclines:
-                if line.find("PR:") != -1:
-                    arr = line.split(":")
-                    rev = arr[1].strip()
-                    recipes[recipe] += "-" + rev
+            for rev in revs:
+                rec.version += "-" + rev
         else:
             print("ERROR: Recipeinfo file {} does not exist\n".format(recipeinfo))
             sys.exit(3)
+        rec.orig_version = rec.version
+
+
+def replace_recipe(layer, recipe, ver, layer_string):
+    # Apply replacefile RECIPE entries - returns replacement layer and recipe/version strings
+    global rep_recipes
+
+    if recipe in rep_recipes.keys():
+        return layer_string, rep_recipes[recipe] + "/" + ver
+    elif recipe + "/" + ver in rep_recipes.keys():
+        return layer_string, rep_recipes[recipe + "/" + ver]
+    elif layer + "/" + recipe in rep_recipes.keys():
+        rep = rep_recipes[layer + "/" + recipe]
+    elif layer + "/" + recipe + "/" + ver in rep_recipes.keys():
+        rep = rep_recipes[layer + "/" + recipe + "/" + ver]
+    else:
+        return layer_string, recipe + "/" + ver
+
+    slash = rep.find("/") + 1
+    return rep.split("/")[0], rep[slash:]
 
 
 def proc_layers():
-    global proj_rel, comps_layers, layers, recipes, recipe_layer
+    global comps_layers, layers, recipes
     global rep_layers
 
     print("- Processing layers: ...")
-    # proj_rel is for the project relationship (project to layers)
+    layer_comps = {}
+    for rec in recipes.values():
+        if rec.component is not None:
+            layer_comps.setdefault(rec.layer, []).append(rec.component)
+
     for layer in layers:
         if layer in rep_layers.keys():
             rep_layer = rep_layers[layer]
         else:
             rep_layer = layer
-        proj_rel.append(
-            {
-                "related": "http:yocto/" + rep_layer + "/1.0",
-                "relationshipType": "DYNAMIC_LINK"
-            }
-        )
-        layer_rel = []
-        for recipe in recipes.keys():
-            if recipe in recipe_layer.keys() and recipe_layer[recipe] == layer:
-                # print("DEBUG: " + recipe)
-                ver = recipes[recipe]
-
-                rec_layer = rep_layer
-                if recipe in rep_recipes.keys():
-                    recipever_string = rep_recipes[recipe] + "/" + ver
-                elif recipe + "/" + ver in rep_recipes.keys():
-                    recipever_string = rep_recipes[recipe + "/" + ver]
-                elif layer + "/" + recipe in rep_recipes.keys():
-                    rec_layer = rep_recipes[rep_layer + "/" + recipe].split("/")[0]
-                    slash = rep_recipes[rep_layer + "/" + recipe].find("/") + 1
-                    recipever_string = rep_recipes[rep_layer + "/" + recipe][slash:]
-                elif layer + "/" + recipe + "/" + ver in rep_recipes.keys():
-                    rec_layer = rep_recipes[rep_layer + "/" + recipe + "/" + ver].split("/")[0]
-                    slash = rep_recipes[rep_layer + "/" + recipe + "/" + ver].find("/") + 1
-                    recipever_string = rep_recipes[rep_layer + "/" + recipe + "/" + ver][slash:]
-                else:
-                    recipever_string = recipe + "/" + ver
-
-                layer_rel.append(
-                    {
-                        "related": "http:yocto/" + rec_layer + "/" + recipever_string,
-                        "relationshipType": "DYNAMIC_LINK"
-                    }
-                )
-
-        comps_layers.append({
-            "@id": "http:yocto/" + rep_layer + "/1.0",
-            "@type": "Component",
-            "externalIdentifier": {
-                "externalSystemTypeId": "@yocto",
-                "externalId": rep_layer,
-                "externalIdMetaData": {
-                    "forge": {
-                        "name": "yocto",
-                        "separator": "/",
-                        "usePreferredNamespaceAlias": True
-                    },
-                    "pieces": [
-                        rep_layer,
-                        "1.0"
-                    ],
-                    "prefix": "meta"
-                }
-            },
-            "relationship": layer_rel
-        })
+        comps_layers.append(LayerComponent(rep_layer, layer_comps.get(layer, [])))
 
 
 def proc_recipes():
-    global recipes, recipe_layer, comps_recipes
-    global rep_recipes, rep_layers
+    global recipes, comps_recipes
+    global rep_layers
 
     print("- Processing recipes: ...")
-    for recipe in recipes.keys():
-        ver = recipes[recipe]
+    for recipe, rec in recipes.items():
+        ver = rec.version
 
-        if recipe in recipe_layer.keys():
-            layer = recipe_layer[recipe]
-            if recipe_layer[recipe] in rep_layers.keys():
-                layer_string = rep_layers[recipe_layer[recipe]]
-            else:
-                layer_string = recipe_layer[recipe]
-
-            if recipe in rep_recipes.keys():
-                recipever_string = rep_recipes[recipe] + "/" + ver
-            elif recipe + "/" + ver in rep_recipes.keys():
-                recipever_string = rep_recipes[recipe + "/" + ver]
-            elif layer + "/" + recipe in rep_recipes.keys():
-                layer_string = rep_recipes[layer + "/" + recipe].split("/")[0]
-                slash = rep_recipes[layer + "/" + recipe].find("/") + 1
-                recipever_string = rep_recipes[layer + "/" + recipe][slash:]
-            elif layer + "/" + recipe + "/" + ver in rep_recipes.keys():
-                layer_string = rep_recipes[layer + "/" + recipe + "/" + ver].split("/")[0]
-                slash = rep_recipes[layer + "/" + recipe + "/" + ver].find("/") + 1
-                recipever_string = rep_recipes[layer + "/" + recipe + "/" + ver][slash:]
+        if rec.layer != "":
+            layer = rec.layer
+            if layer in rep_layers.keys():
+                layer_string = rep_layers[layer]
             else:
-                recipever_string = recipe + "/" + ver
+                layer_string = layer
+
+            layer_string, recipever_string = replace_recipe(layer, recipe, ver, layer_string)
 
             if recipe + "/" + ver != recipever_string:
                 print(
                     "INFO: Replaced layer/recipe {}/{} with {}/{} from replacefile".format(layer, recipe, layer_string,
                                                                                            recipever_string))
 
-            comps_recipes.append(
-                {
-                    "@id": "http:yocto/" + layer_string + "/" + recipever_string,
-                    "@type": "Component",
-                    "externalIdentifier": {
-                        "externalSystemTypeId": "@yocto",
-                        "externalId": layer_string + "/" + recipever_string,
-                        "externalIdMetaData": {
-                            "forge": {
-                                "name": "yocto",
-                                "separator": "/",
-                                "usePreferredNamespaceAlias": True
-                            },
-                            "pieces": [
-                                recipever_string.replace("/", ",")
-                            ],
-                            "prefix": layer_string
-                        }
-                    },
-                    "relationship": []
-                })
-
-
-def write_bdio(bdio):
+            rec.component = Component(layer_string, recipever_string)
+            comps_recipes.append(rec.component)
+
+
+class HubGovernor:
+    # Limits concurrent Black Duck API requests across all threads. The limit is adjusted AIMD style - it
+    # increases by one after a full window of fast successful requests, and halves on a 429/503 response
+    # (which is retried) or when a request exceeds the latency target. Scan uploads are governed with
+    # call_untimed() as their duration depends on the scan size rather than server load.
+    def __init__(self, max_limit, latency_target):
+        self.cond = threading.Condition()
+        self.limit = float(min(GOVERNOR_INITIAL_LIMIT, max_limit))
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.slow = 0
+        self.min_limit = self.limit
+        self.peak_limit = self.limit
+
+    def call(self, func, *args, **kwargs):
+        return self.run(func, True, args, kwargs)
+
+    def call_untimed(self, func, *args, **kwargs):
+        return self.run(func, False, args, kwargs)
+
+    def run(self, func, timed, args, kwargs):
+        for attempt in range(GOVERNOR_RETRIES):
+            with self.cond:
+                while self.in_flight >= int(self.limit):
+                    self.cond.wait()
+                self.in_flight += 1
+                self.requests += 1
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                with self.cond:
+                    self.in_flight -= 1
+                    self.cond.notify_all()
+
+            status = getattr(result, 'status_code', None)
+            if status in (429, 503) and attempt < GOVERNOR_RETRIES - 1:
+                self.decrease()
+                with self.cond:
+                    self.throttled += 1
+                delay = 2 ** attempt
+                try:
+                    delay = max(delay, int(result.headers.get('Retry-After', 0)))
+                except (AttributeError, ValueError):
+                    pass
+                time.sleep(delay)
+                continue
+
+            if timed:
+                if time.time() - start > self.latency_target:
+                    with self.cond:
+                        self.slow += 1
+                    self.decrease()
+                else:
+                    self.increase()
+            return result
+
+    def increase(self):
+        with self.cond:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self.peak_limit = max(self.peak_limit, self.limit)
+            self.cond.notify_all()
+
+    def decrease(self):
+        with self.cond:
+            self.limit = max(1.0, self.limit / 2)
+            self.min_limit = min(self.min_limit, self.limit)
+
+    def print_metrics(self):
+        print("- Black Duck API requests: {} (throttled {}, slow {}) - concurrency limit {} (range {}-{}, max {})".format(
+            self.requests, self.throttled, self.slow, int(self.limit), int(self.min_limit), int(self.peak_limit),
+            self.max_limit))
+
+
+def create_bdio(scan_name, layer_comps, recipe_comps):
     global args
 
-    if args.output_json != "":
-        try:
-            o = open(args.output_json, "w")
-            o.write(json.dumps(bdio, indent=4))
-            o.close()
-            print("\nJSON project file written to {} - must be manually uploaded".format(args.output_json))
-        except Exception as e:
-            print("ERROR: Unable to write output JSON file {}\n".format(args.output_json) + str(e))
-            return False
+    mytime = datetime.datetime.now()
+    bdio_header = {
+        "specVersion": "1.1.0",
+        "spdx:name": scan_name,
+        "creationInfo": {
+            "spdx:creator": [
+                "Tool: Detect-6.3.0",
+                "Tool: IntegrationBdio-21.0.1"
+            ],
+            "spdx:created": mytime.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        },
+        "@id": "uuid:" + str(uuid.uuid1()),
+        "@type": "BillOfMaterials",
+        "relationship": []
+    }
+
+    bdio_project = {
+        "name": args.project,
+        "revision": args.version,
+        "@id": "http:yocto/" + args.project + "/" + args.version,
+        "@type": "Project",
+        "externalIdentifier": {
+            "externalSystemTypeId": "@yocto",
+            "externalId": "yocto/" + args.project + "/" + args.version,
+            "externalIdMetaData": {
+                "forge": {
+                    "name": "yocto",
+                    "separator": ":",
+                    "usePreferredNamespaceAlias": True
+                },
+                "pieces": [
+                    args.project,
+                    args.version
+                ],
+                "prefix": ""
+            }
+        },
+        # Project relationship (project to layers)
+        "relationship": [comp.relationship() for comp in layer_comps]
+    }
 
-    else:
-        import tempfile
-        try:
-            with tempfile.NamedTemporaryFile(suffix=".jsonld", delete=False) as o:
-                args.output_json = o.name
-                o.write(json.dumps(bdio, indent=4).encode())
-                o.close()
-        except Exception as e:
-            print("ERROR: Unable to write temporary output JSON file\n" + str(e))
-            return False
+    return [bdio_header, bdio_project, layer_comps, recipe_comps]
 
-    return True
 
+def shard_layers(num_shards):
+    # Split layer components (with their recipe components) into shards balanced by recipe count
+    global comps_layers, comps_recipes
+
+    shards = [([], []) for num in range(max(1, min(num_shards, len(comps_layers))))]
+    for lcomp in sorted(comps_layers, key=lambda c: len(c.recipe_comps), reverse=True):
+        shard = min(shards, key=lambda sh: len(sh[1]))
+        shard[0].append(lcomp)
+        shard[1].extend(lcomp.recipe_comps)
+
+    # Recipe components not linked from a layer go in the first shard
+    linked = set(id(comp) for lcomp in comps_layers for comp in lcomp.recipe_comps)
+    shards[0][1].extend([comp for comp in comps_recipes if id(comp) not in linked])
 
-def upload_json(jsonfile):
-    hub = HubInstance()
-    r = hub.upload_scan(jsonfile)
+    print("- Split BOM into {} shards by layer".format(len(shards)))
+    return shards
+
+
+BDIO_CHUNK_SIZE = 65536
+BDIO2_CONTEXT = "https://blackducksoftware.github.io/bdio/2.0.0"
+BDIO2_ENTRY_NODES = 10000
+
+
+class StreamSink:
+    # Write-only (unseekable) file object collecting output for a generator to hand on in chunks
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def bdio1_stream(bdio):
+    # Generate BDIO 1 JSON-LD document incrementally in chunks of bytes
+    buf = []
+    size = 0
+    for part in json.JSONEncoder(indent=4, default=bdio_default).iterencode(bdio):
+        buf.append(part)
+        size += len(part)
+        if size >= BDIO_CHUNK_SIZE:
+            yield "".join(buf).encode()
+            buf = []
+            size = 0
+    yield "".join(buf).encode()
+
+
+def bdio2_stream(bdio):
+    # Generate BDIO 2 zip (header plus JSON-LD graph entries of up to BDIO2_ENTRY_NODES nodes) in chunks of bytes
+    import zipfile
+
+    bdio_header, bdio_project, layer_comps, recipe_comps = bdio
+    project = {
+        "@id": bdio_project['@id'],
+        "@type": "Project",
+        "namespace": "yocto",
+        "identifier": bdio_project['externalIdentifier']['externalId'],
+        "name": bdio_project['name'],
+        "version": bdio_project['revision'],
+        "dependency": [comp.dependency() for comp in layer_comps]
+    }
+
+    sink = StreamSink()
+    z = zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED)
+    z.writestr("bdio-header.jsonld", json.dumps({
+        "@context": BDIO2_CONTEXT,
+        "@id": bdio_header['@id'],
+        "name": bdio_header['spdx:name'],
+        "creationDateTime": bdio_header['creationInfo']['spdx:created'],
+        "creator": bdio_header['creationInfo']['spdx:creator'][0]
+    }, indent=4))
+    yield sink.take()
+
+    nodes = itertools.chain([project], layer_comps, recipe_comps)
+    entry = 0
+    while True:
+        graph = list(itertools.islice(nodes, BDIO2_ENTRY_NODES))
+        if len(graph) == 0:
+            break
+        with z.open("bdio-entry-{:02d}.jsonld".format(entry), "w") as e:
+            for part in json.JSONEncoder(indent=4, default=bdio2_default).iterencode({
+                    "@context": BDIO2_CONTEXT,
+                    "@id": bdio_header['@id'],
+                    "@graph": graph}):
+                e.write(part.encode())
+                if sink.size >= BDIO_CHUNK_SIZE:
+                    yield sink.take()
+        entry += 1
+    z.close()
+    yield sink.take()
+
+
+def bdio_stream(bdio):
+    global args
+
+    if args.bdio2:
+        return bdio2_stream(bdio)
+    return bdio1_stream(bdio)
+
+
+def write_bdio(bdio, output_json):
+    # Write BDIO to output_json - returns the file written or "" on error
+    try:
+        o = open(output_json, "wb")
+        for chunk in bdio_stream(bdio):
+            o.write(chunk)
+        o.close()
+        print("\n{} project file written to {} - must be manually uploaded".format(
+            "BDIO 2" if args.bdio2 else "JSON", output_json))
+    except Exception as e:
+        print("ERROR: Unable to write output JSON file {}\n".format(output_json) + str(e))
+        return ""
+
+    return output_json
+
+
+def upload_bdio(bdio, hub=None):
+    # Upload BDIO to the server, streaming the generated document into the request body (no temporary file)
+    global args
+    import requests
+
+    try:
+        if hub is None:
+            hub = governor.call(HubInstance)
+        url = hub.get_apibase() + "/scan/data/?mode=replace"
+        headers = hub.get_headers()
+        if args.bdio2:
+            headers['Content-Type'] = 'application/vnd.blackducksoftware.bdio+zip'
+        else:
+            headers['Content-Type'] = 'application/ld+json'
+        # New generator for each attempt as throttled requests are retried
+        r = governor.call_untimed(lambda: requests.post(url, headers=headers, data=bdio_stream(bdio),
+                                                verify=not hub.config['insecure']))
+    except Exception as e:
+        # Includes errors raised while generating the BDIO during the upload
+        print("ERROR: Unable to upload scan to Black Duck server\n" + str(e))
+        return False
     if r.status_code == 201:
         return True
     else:
         return False
 
 
+def upload_shards(bdios):
+    # Upload BDIOs concurrently using a single Hub connection - returns True if all uploads succeeded
+    from concurrent.futures import ThreadPoolExecutor
+
+    if len(bdios) == 1:
+        return upload_bdio(bdios[0])
+
+    try:
+        hub = governor.call(HubInstance)
+    except Exception as e:
+        print("ERROR: Unable to connect to Black Duck server\n" + str(e))
+        return False
+    with ThreadPoolExecutor(max_workers=min(len(bdios), UPLOAD_THREADS)) as executor:
+        results = list(executor.map(lambda bdio: upload_bdio(bdio, hub), bdios))
+    return all(results)
+
+
 def patch_vuln(hub, comp):
     status = "PATCHED"
     comment = "Patched by bitbake recipe"
@@ -481,7 +1332,7 @@ def patch_vuln(hub, comp):
 
         comp['remediationStatus'] = status
         comp['remediationComment'] = comment
-        result = hub.execute_put(comp['_meta']['href'], data=comp)
+        result = governor.call(hub.execute_put, comp['_meta']['href'], data=comp)
         if result.status_code != 202:
             return False
 
@@ -492,45 +1343,588 @@ def patch_vuln(hub, comp):
     return True
 
 
-def process_patched_cves(hub, version, vuln_list):
+def journal_file():
     global args
 
-    try:
-        vulnerable_components_url = hub.get_link(version, "vulnerable-components") + "?limit=9999"
-        custom_headers = {'Accept': 'application/vnd.blackducksoftware.bill-of-materials-6+json'}
-        response = hub.execute_get(vulnerable_components_url, custom_headers=custom_headers)
-        vulnerable_bom_components = response.json().get('items', [])
+    if args.journal != "":
+        return args.journal
+    return os.path.join(get_cache_dir(), "remediation_journal.jsonl")
+
+
+def load_journal(project, version):
+    # Load the last processed BOM for the project version
+    jstate = {'project': project, 'version': version, 'bom': ""}
+    jfile = ""
+    try:
+        jfile = journal_file()
+        if not os.path.isfile(jfile):
+            return jstate
+        j = open(jfile, "r")
+        for line in j:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # Incomplete record from an interrupted run
+                continue
+            if rec.get('project') != project or rec.get('version') != version:
+                continue
+            if rec['type'] == 'bom':
+                jstate['bom'] = rec['digest']
+        j.close()
+    except Exception as e:
+        print("WARNING: Unable to read journal - ignored\n" + str(e))
+    return jstate
+
+
+def journal_append(jstate, rec):
+    # Append a record for the project version to the journal and flush it to disk before continuing
+    global journal_lock
+
+    rec['project'] = jstate['project']
+    rec['version'] = jstate['version']
+    try:
+        with journal_lock:
+            j = open(journal_file(), "a")
+            j.write(json.dumps(rec) + "\n")
+            j.flush()
+            os.fsync(j.fileno())
+            j.close()
+    except Exception as e:
+        print("WARNING: Unable to update journal file - ignored\n" + str(e))
+
+
+def bom_digest(shards):
+    # Digest of the BOM content (components and relationships) used to detect unchanged BOMs with --resume
+    import hashlib
+
+    h = hashlib.sha256()
+    for layer_comps, recipe_comps in shards:
+        for lcomp in layer_comps:
+            h.update(("L " + lcomp.get_id() + "\n").encode())
+            for comp in lcomp.recipe_comps:
+                h.update(("R " + comp.get_id() + "\n").encode())
+        for comp in recipe_comps:
+            h.update(("C " + comp.get_id() + "\n").encode())
+        h.update(b"--\n")
+    return h.hexdigest()
+
+
+def open_bdsa_cache():
+    global args
+    import sqlite3
+
+    cachefile = args.bdsa_cache
+    if cachefile == "":
+        cachefile = os.path.join(get_cache_dir(), "bdsa_cves.db")
+    conn = sqlite3.connect(cachefile, timeout=60)
+    conn.execute("CREATE TABLE IF NOT EXISTS bdsa_cves (bdsa TEXT PRIMARY KEY, cves TEXT NOT NULL, updated REAL NOT NULL)")
+    return conn
+
+
+def bdsa_cache_load(bdsas):
+    # Return unexpired BDSA to CVE mappings from the persistent cache
+    global args
+
+    mappings = {}
+    expiry = time.time() - args.bdsa_cache_ttl * 86400
+    names = sorted(bdsas)
+    try:
+        conn = open_bdsa_cache()
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            rows = conn.execute("SELECT bdsa, cves FROM bdsa_cves WHERE updated >= ? AND bdsa IN ({})".format(
+                ",".join("?" * len(chunk))), [expiry] + chunk)
+            for bdsa, cves in rows:
+                mappings[bdsa] = json.loads(cves)
+        conn.close()
+    except Exception as e:
+        print("WARNING: Unable to read BDSA cache - ignored\n" + str(e))
+    return mappings
+
+
+def bdsa_cache_store(mappings):
+    now = time.time()
+    try:
+        conn = open_bdsa_cache()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO bdsa_cves VALUES (?, ?, ?)",
+                             [(bdsa, json.dumps(cves), now) for bdsa, cves in mappings.items()])
+        conn.close()
+    except Exception as e:
+        print("WARNING: Unable to update BDSA cache - ignored\n" + str(e))
+
+
+STATE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, project TEXT NOT NULL, version TEXT NOT NULL,
+    started REAL NOT NULL, source TEXT, bom TEXT);
+CREATE INDEX IF NOT EXISTS runs_project_version ON runs (project, version);
+CREATE TABLE IF NOT EXISTS recipes (run INTEGER NOT NULL, recipe TEXT NOT NULL, layer TEXT, version TEXT,
+    orig_version TEXT, outcome TEXT, component TEXT);
+CREATE INDEX IF NOT EXISTS recipes_run ON recipes (run);
+CREATE INDEX IF NOT EXISTS recipes_layer ON recipes (layer);
+CREATE TABLE IF NOT EXISTS components (run INTEGER NOT NULL, component TEXT NOT NULL, layer TEXT);
+CREATE INDEX IF NOT EXISTS components_run ON components (run);
+CREATE INDEX IF NOT EXISTS components_layer ON components (layer);
+CREATE TABLE IF NOT EXISTS remediations (project TEXT NOT NULL, version TEXT NOT NULL, vuln TEXT, cve TEXT,
+    href TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (project, version, href));
+CREATE INDEX IF NOT EXISTS remediations_cve ON remediations (cve);
+CREATE TABLE IF NOT EXISTS cve_checks (project TEXT NOT NULL, version TEXT NOT NULL, cve TEXT NOT NULL,
+    updated REAL NOT NULL, PRIMARY KEY (project, version, cve));
+CREATE INDEX IF NOT EXISTS cve_checks_cve ON cve_checks (cve);
+CREATE TABLE IF NOT EXISTS cve_check_boms (project TEXT NOT NULL, version TEXT NOT NULL, bom TEXT NOT NULL,
+    updated REAL NOT NULL, PRIMARY KEY (project, version));
+'''
+
+
+def open_state_db():
+    global args
+    import sqlite3
+
+    statefile = args.state_db
+    if statefile == "":
+        statefile = os.path.join(get_cache_dir(), "state.db")
+    conn = sqlite3.connect(statefile, timeout=60)
+    conn.executescript(STATE_SCHEMA)
+    return conn
+
+
+def state_record_run(digest):
+    # Record the recipes, KB mapping outcomes and emitted components for this run in the state store
+    global args, recipes, comps_layers, comps_recipes
+
+    if args.no_state:
+        return
+    try:
+        conn = open_state_db()
+        with conn:
+            cur = conn.execute("INSERT INTO runs (project, version, started, source, bom) VALUES (?, ?, ?, ?, ?)",
+                               (args.project, args.version, time.time(),
+                                os.path.abspath(args.buildhistory if args.buildhistory != "" else args.manifest),
+                                digest))
+            run = cur.lastrowid
+            conn.executemany("INSERT INTO recipes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [(run, recipe, rec.layer, rec.version, rec.orig_version, rec.outcome,
+                               None if rec.component is None else rec.component.layer + "/" + rec.component.recipever)
+                              for recipe, rec in recipes.items()])
+            conn.executemany("INSERT INTO components VALUES (?, ?, ?)",
+                             [(run, comp.layer + "/" + comp.recipever, comp.layer)
+                              for comp in comps_layers + comps_recipes])
+        conn.close()
+    except Exception as e:
+        print("WARNING: Unable to update state store - ignored\n" + str(e))
+
+
+def state_record_remediations(project, version, cves, patched, bom):
+    # Record the patched CVEs processed and the vulnerabilities remediated in the project version, and the BOM
+    # (digest or server scan date) they were processed against
+    global args
+
+    if args.no_state:
+        return
+    now = time.time()
+    try:
+        conn = open_state_db()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO remediations VALUES (?, ?, ?, ?, ?, ?)",
+                             [(project, version, vuln, cve, href, now) for (vuln, cve, href) in patched])
+            conn.executemany("INSERT OR REPLACE INTO cve_checks VALUES (?, ?, ?, ?)",
+                             [(project, version, cve, now) for cve in cves])
+            conn.execute("INSERT OR REPLACE INTO cve_check_boms VALUES (?, ?, ?, ?)", (project, version, bom, now))
+        conn.close()
+    except Exception as e:
+        print("WARNING: Unable to update state store - ignored\n" + str(e))
+
+
+def state_cves_checked(project, version, cves, bom):
+    # Return True if all patched CVEs have already been processed for the project version with the same BOM
+    global args
+
+    if args.no_state or len(cves) == 0 or bom == "":
+        return False
+    try:
+        conn = open_state_db()
+        row = conn.execute("SELECT bom FROM cve_check_boms WHERE project = ? AND version = ?",
+                           (project, version)).fetchone()
+        checked = set(row[0] for row in conn.execute("SELECT cve FROM cve_checks WHERE project = ? AND version = ?",
+                                                     (project, version)))
+        conn.close()
+    except Exception as e:
+        print("WARNING: Unable to read state store - ignored\n" + str(e))
+        return False
+    return row is not None and row[0] == bom and set(cves) <= checked
+
+
+def state_last_run(conn, project, version):
+    row = conn.execute("SELECT MAX(id) FROM runs WHERE project = ? AND version = ?", (project, version)).fetchone()
+    return row[0]
+
+
+def state_report():
+    # Print the KB mapping outcomes and remediations recorded for the project version (no server access)
+    global args
+
+    conn = open_state_db()
+    run = state_last_run(conn, args.project, args.version)
+    if run is None:
+        print("No runs recorded in state store for project '{}/{}'".format(args.project, args.version))
+        conn.close()
+        return False
+
+    started, source = conn.execute("SELECT started, source FROM runs WHERE id = ?", (run,)).fetchone()
+    print("Project '{}/{}' last imported {} from {}".format(
+        args.project, args.version, datetime.datetime.fromtimestamp(started).strftime("%Y-%m-%d %H:%M:%S"), source))
+    print("- Recipes by KB mapping outcome:")
+    for outcome, count in conn.execute("SELECT outcome, COUNT(*) FROM recipes WHERE run = ? GROUP BY outcome "
+                                       "ORDER BY outcome", (run,)):
+        print("	{:<28} {}".format(outcome, count))
+    for recipe, layer, version, orig_version, outcome in conn.execute(
+            "SELECT recipe, layer, version, orig_version, outcome FROM recipes WHERE run = ? AND outcome NOT IN "
+            "('OK', 'NOTCHECKED') ORDER BY outcome, layer, recipe", (run,)):
+        if version != orig_version:
+            print("	{}: {}/{}/{} (originally {})".format(outcome, layer, recipe, version, orig_version))
+        else:
+            print("	{}: {}/{}/{}".format(outcome, layer, recipe, version))
+    print("- {} components in BOM".format(conn.execute("SELECT COUNT(*) FROM components WHERE run = ?",
+                                                       (run,)).fetchone()[0]))
+    print("- {} vulnerabilities marked as patched".format(conn.execute(
+        "SELECT COUNT(*) FROM remediations WHERE project = ? AND version = ?",
+        (args.project, args.version)).fetchone()[0]))
+    conn.close()
+    return True
+
+
+def state_diff(other_version):
+    # Print differences between the last runs recorded for another version and the project version
+    global args
+
+    conn = open_state_db()
+    runs = []
+    for version in [other_version, args.version]:
+        run = state_last_run(conn, args.project, version)
+        if run is None:
+            print("No runs recorded in state store for project '{}/{}'".format(args.project, version))
+            conn.close()
+            return False
+        runs.append(run)
+
+    print("Differences between project versions '{}/{}' and '{}/{}':".format(args.project, other_version,
+                                                                            args.project, args.version))
+    old, new = [set(row[0] for row in conn.execute("SELECT component FROM components WHERE run = ?", (run,)))
+                for run in runs]
+    print("- Components: {} added, {} removed".format(len(new - old), len(old - new)))
+    for comp in sorted(new - old):
+        print("	+ {}".format(comp))
+    for comp in sorted(old - new):
+        print("	- {}".format(comp))
+
+    old, new = [dict((row[0], row[1:]) for row in conn.execute(
+        "SELECT recipe, version, outcome FROM recipes WHERE run = ?", (run,))) for run in runs]
+    changed = sorted(recipe for recipe in set(old) & set(new) if old[recipe] != new[recipe])
+    print("- Recipes: {} added, {} removed, {} changed version or KB mapping outcome".format(
+        len(set(new) - set(old)), len(set(old) - set(new)), len(changed)))
+    for recipe in changed:
+        print("	{}: {} {} -> {} {}".format(recipe, old[recipe][0], old[recipe][1], new[recipe][0], new[recipe][1]))
+
+    old, new = [set(row[0] for row in conn.execute(
+        "SELECT DISTINCT cve FROM remediations WHERE project = ? AND version = ?", (args.project, version)))
+                for version in [other_version, args.version]]
+    print("- Patched CVEs: {} only in '{}', {} only in '{}'".format(len(old - new), other_version, len(new - old),
+                                                                   args.version))
+    for cve in sorted(old - new):
+        print("	- {}".format(cve))
+    for cve in sorted(new - old):
+        print("	+ {}".format(cve))
+    conn.close()
+    return True
+
+
+def fetch_bdsa_cves(hub, bdsa):
+    # Return list of NVD CVEs related to BDSA vulnerability from the server
+    vuln_url = hub.get_apibase() + "/vulnerabilities/" + bdsa
+    custom_headers = {'Accept': 'application/vnd.blackducksoftware.vulnerability-4+json'}
+    resp = governor.call(hub.execute_get, vuln_url, custom_headers=custom_headers)
+    vuln = resp.json()
+    # print(json.dumps(vuln, indent=4))
+    cves = []
+    for x in vuln['_meta']['links']:
+        if x['rel'] == 'related-vulnerability':
+            if x['label'] == 'NVD':
+                cves.append(x['href'].split("/")[-1])
+    return cves
+
+
+def warm_bdsa_cves(hub, bdsas):
+    # Resolve all BDSAs from the persistent cache, looking up the remainder from the server in parallel
+    # (serialized so concurrent project versions share the lookups)
+    global bdsa_cves, bdsa_lock
+    from concurrent.futures import ThreadPoolExecutor
+
+    with bdsa_lock:
+        needed = set(bdsas) - set(bdsa_cves.keys())
+        if len(needed) == 0:
+            return
+
+        cached = bdsa_cache_load(needed)
+        bdsa_cves.update(cached)
+        missing = sorted(needed - set(cached.keys()))
+        if len(missing) > 0:
+            with ThreadPoolExecutor(max_workers=VULN_THREADS) as executor:
+                fetched = dict(zip(missing, executor.map(lambda bdsa: fetch_bdsa_cves(hub, bdsa), missing)))
+            bdsa_cves.update(fetched)
+            bdsa_cache_store(fetched)
+    print("- Resolved {} BDSA vulnerabilities ({} from cache, {} from server)".format(len(needed), len(cached),
+                                                                                     len(missing)))
+
+
+def get_bdsa_cves(hub, bdsa):
+    # Return list of NVD CVEs related to BDSA vulnerability
+    global bdsa_cves
+
+    if bdsa in bdsa_cves:
+        return bdsa_cves[bdsa]
+
+    cves = fetch_bdsa_cves(hub, bdsa)
+    bdsa_cves[bdsa] = cves
+    bdsa_cache_store({bdsa: cves})
+    return cves
+
+
+def get_vulnerable_components(hub, version, source, vuln_name="", limit=9999):
+    # Get vulnerable BOM components with actionable remediation status for the vulnerability source,
+    # optionally only for the named vulnerability - returns (total count, list of components)
+    import urllib.parse
+
+    url = hub.get_link(version, "vulnerable-components") + "?limit={}".format(limit)
+    for status in ACTIONABLE_STATUSES:
+        url += "&filter=remediationStatus:" + status.lower()
+    url += "&filter=vulnerabilitySource:" + source.lower()
+    if vuln_name != "":
+        url += "&q=vulnerabilityName:" + urllib.parse.quote(vuln_name)
+    custom_headers = {'Accept': 'application/vnd.blackducksoftware.bill-of-materials-6+json'}
+    response = governor.call(hub.execute_get, url, custom_headers=custom_headers)
+    data = response.json()
+
+    # Recheck filters in case they are not supported by the server version
+    comps = []
+    for comp in data.get('items', []):
+        if comp['vulnerabilityWithRemediation']['source'] != source:
+            continue
+        if comp['vulnerabilityWithRemediation'].get('remediationStatus', 'NEW') not in ACTIONABLE_STATUSES:
+            continue
+        if vuln_name != "" and comp['vulnerabilityWithRemediation']['vulnerabilityName'] != vuln_name:
+            continue
+        comps.append(comp)
+    return data.get('totalCount', len(comps)), comps
+
+
+def get_nvd_components(hub, version, vuln_set):
+    # Query per CVE in parallel if the patched CVE list is much smaller than the list of vulnerable components
+    from concurrent.futures import ThreadPoolExecutor
+
+    total, comps = get_vulnerable_components(hub, version, "NVD", limit=1)
+    if len(vuln_set) * PER_CVE_QUERY_RATIO >= total:
+        total, comps = get_vulnerable_components(hub, version, "NVD")
+        return comps
+
+    cves = sorted(vuln_set)
+    first_total, first_comps = get_vulnerable_components(hub, version, "NVD", cves[0])
+    if first_total >= total:
+        # Server ignored the vulnerability name query - get all components in a single request instead
+        total, comps = get_vulnerable_components(hub, version, "NVD")
+        return comps
+
+    print("- Querying {} patched CVEs individually ({} vulnerable NVD components in project)".format(len(vuln_set),
+                                                                                                    total))
+    with ThreadPoolExecutor(max_workers=VULN_THREADS) as executor:
+        results = [first_comps] + list(executor.map(
+            lambda cve: get_vulnerable_components(hub, version, "NVD", cve)[1], cves[1:]))
+
+    comps = []
+    hrefs = set()
+    for result in results:
+        for comp in result:
+            if comp['_meta']['href'] not in hrefs:
+                hrefs.add(comp['_meta']['href'])
+                comps.append(comp)
+    return comps
+
+
+def process_patched_cves(hub, version, vuln_list, project, version_name, bom):
+    # Mark patched CVEs as PATCHED in the project version - returns number of CVEs patched or -1 on error
+    # (bom identifies the BOM processed for --resume, "" if unknown). Only vulnerabilities the server reports
+    # as not yet remediated are returned, so an interrupted run is resumed by rerunning it.
+
+    vuln_set = set(vuln_list)
+    try:
+        vulnerable_bom_components = get_nvd_components(hub, version, vuln_set)
+        bdsa_components = get_vulnerable_components(hub, version, "BDSA")[1]
+        warm_bdsa_cves(hub, [comp['vulnerabilityWithRemediation']['vulnerabilityName'] for comp in bdsa_components])
+        vulnerable_bom_components += bdsa_components
 
         count = 0
+        patched = []
 
         for comp in vulnerable_bom_components:
+            vuln_name = comp['vulnerabilityWithRemediation']['vulnerabilityName']
             if comp['vulnerabilityWithRemediation']['source'] == "NVD":
-                if comp['vulnerabilityWithRemediation']['vulnerabilityName'] in vuln_list:
+                if vuln_name in vuln_set:
                     if patch_vuln(hub, comp):
-                        print("		Patched {}".format(comp['vulnerabilityWithRemediation']['vulnerabilityName']))
+                        print("		Patched {}".format(vuln_name))
+                        patched.append((vuln_name, vuln_name, comp['_meta']['href']))
                         count += 1
             elif comp['vulnerabilityWithRemediation']['source'] == "BDSA":
-                vuln_url = hub.get_apibase() + "/vulnerabilities/" + comp['vulnerabilityWithRemediation'][
-                    'vulnerabilityName']
-                custom_headers = {'Accept': 'application/vnd.blackducksoftware.vulnerability-4+json'}
-                resp = hub.execute_get(vuln_url, custom_headers=custom_headers)
-                vuln = resp.json()
-                # print(json.dumps(vuln, indent=4))
-                for x in vuln['_meta']['links']:
-                    if x['rel'] == 'related-vulnerability':
-                        if x['label'] == 'NVD':
-                            cve = x['href'].split("/")[-1]
-                            if cve in vuln_list:
-                                if patch_vuln(hub, comp):
-                                    print("		Patched " + vuln['name'] + ": " + cve)
-                                    count += 1
+                for cve in get_bdsa_cves(hub, vuln_name):
+                    if cve in vuln_set:
+                        if patch_vuln(hub, comp):
+                            print("		Patched " + vuln_name + ": " + cve)
+                            patched.append((vuln_name, cve, comp['_meta']['href']))
+                            count += 1
+                        break
 
     except Exception as e:
         print("ERROR: Unable to get components from project via API\n" + str(e))
+        return -1
+
+    state_record_remediations(project, version_name, vuln_set, patched, bom)
+    print("- {} CVEs marked as patched in project '{}/{}'".format(count, project, version_name))
+    return count
+
+
+def read_cve_check_file(cvefile):
+    # Return list of (package, CVE) for patched CVEs in cve_check output file or None on error
+    patched = []
+    pkgvuln = {}
+    try:
+        f = open_input(cvefile)
+        for line in f:
+            arr = line.split(":")
+            if len(arr) > 1:
+                key = arr[0]
+                value = arr[1].strip()
+                if key == "PACKAGE NAME":
+                    pkgvuln['package'] = value
+                elif key == "PACKAGE VERSION":
+                    pkgvuln['version'] = value
+                elif key == "CVE":
+                    pkgvuln['CVE'] = value
+                elif key == "CVE STATUS":
+                    pkgvuln['status'] = value
+                    if pkgvuln['status'] == "Patched":
+                        patched.append((pkgvuln['package'], pkgvuln['CVE']))
+                    pkgvuln = {}
+        f.close()
+    except Exception as e:
+        print("ERROR: Unable to read CVE check output file {}\n".format(cvefile) + str(e))
+        return None
+    return patched
+
+
+def load_fleet(fleetfile):
+    # Return list of {project, version, cve_check_file} entries from fleet file or None on error
+    try:
+        f = open(fleetfile, "r")
+        fleet = json.load(f)
+        f.close()
+    except Exception as e:
+        print("ERROR: Unable to read fleet file {}\n".format(fleetfile) + str(e))
+        return None
+
+    if not isinstance(fleet, list):
+        print("ERROR: Fleet file {} must contain a list of project versions".format(fleetfile))
+        return None
+    seen = set()
+    for entry in fleet:
+        if not isinstance(entry, dict) or not all(entry.get(key, "") != "" for key in
+                                                  ['project', 'version', 'cve_check_file']):
+            print("ERROR: Fleet entry {} must specify project, version and cve_check_file".format(json.dumps(entry)))
+            return None
+        if (entry['project'], entry['version']) in seen:
+            print("ERROR: Project version '{}/{}' specified more than once in fleet file".format(entry['project'],
+                                                                                                entry['version']))
+            return None
+        seen.add((entry['project'], entry['version']))
+    return fleet
+
+
+def scan_bom_marker(version):
+    # Identify the BOM of an existing project version by its last scan date - the BOM is unchanged if the
+    # project version has not been scanned since ("" if not reported)
+    scandate = version.get('lastScanDate', "")
+    if scandate == "":
+        return ""
+    return "scan:" + scandate
+
+
+def fleet_remediate(hub, entry, patched_vulns):
+    # Apply patched CVEs to one project version - returns summary dict
+    result = {'project': entry['project'], 'version': entry['version'], 'cves': len(patched_vulns),
+              'patched': 0, 'status': "OK"}
+    try:
+        version = governor.call(hub.get_project_version_by_name, entry['project'], entry['version'])
+    except Exception as e:
+        print("ERROR: Unable to get project version '{}/{}' from API\n".format(entry['project'], entry['version']) +
+              str(e))
+        version = None
+    if version is None:
+        result['status'] = "NOT FOUND"
+        return result
+
+    bom = scan_bom_marker(version)
+    if args.resume and state_cves_checked(entry['project'], entry['version'], patched_vulns, bom):
+        print("- Project '{}/{}' - all patched CVEs already processed for unchanged BOM (from state store)".format(
+            entry['project'], entry['version']))
+        result['status'] = "UNCHANGED"
+        return result
+
+    print("- Processing project '{}/{}' ...".format(entry['project'], entry['version']))
+    if len(patched_vulns) > 0:
+        count = process_patched_cves(hub, version, patched_vulns, entry['project'], entry['version'], bom)
+        if count < 0:
+            result['status'] = "ERROR"
+        else:
+            result['patched'] = count
+    return result
+
+
+def fleet_cve_check():
+    # Apply cve_check results to all project versions in the fleet file concurrently
+    global args
+    from concurrent.futures import ThreadPoolExecutor
+
+    fleet = load_fleet(args.fleet)
+    if fleet is None:
         return False
 
-    print("- {} CVEs marked as patched in project '{}/{}'".format(count, args.project, args.version))
-    return True
+    print("- Loading CVEs from {} cve_check logs ...".format(len(set(entry['cve_check_file'] for entry in fleet))))
+    cvefiles = {}
+    for entry in fleet:
+        cvefile = entry['cve_check_file']
+        if cvefile not in cvefiles:
+            patched = read_cve_check_file(cvefile)
+            if patched is None:
+                return False
+            cvefiles[cvefile] = [cve for (package, cve) in patched]
+            print("      {} patched CVEs identified in {}".format(len(cvefiles[cvefile]), cvefile))
+
+    try:
+        hub = governor.call(HubInstance)
+    except Exception as e:
+        print("ERROR: Unable to connect to Black Duck server\n" + str(e))
+        return False
+
+    print("\nProcessing {} project versions ...".format(len(fleet)))
+    with ThreadPoolExecutor(max_workers=args.fleet_workers) as executor:
+        results = list(executor.map(lambda entry: fleet_remediate(hub, entry, cvefiles[entry['cve_check_file']]),
+                                    fleet))
+
+    width = max([len("Project/Version")] + [len(r['project'] + "/" + r['version']) for r in results])
+    print("\nFleet summary:")
+    print("    {:<{w}}  {:>12}  {:>12}  {}".format("Project/Version", "Patched CVEs", "Newly Marked", "Status",
+                                                  w=width))
+    for r in results:
+        print("    {:<{w}}  {:>12}  {:>12}  {}".format(r['project'] + "/" + r['version'], r['cves'], r['patched'],
+                                                      r['status'], w=width))
+    return all(r['status'] in ["OK", "UNCHANGED"] for r in results)
 
 
 def wait_for_bom_completion(hub, ver):
@@ -542,13 +1936,13 @@ def wait_for_bom_completion(hub, ver):
 
         href = link['href']
         custom_headers = {'Accept': 'application/vnd.blackducksoftware.internal-1+json'}
-        resp = hub.execute_get(href, custom_headers=custom_headers)
+        resp = governor.call(hub.execute_get, href, custom_headers=custom_headers)
 
         loop = 0
         uptodate = resp.json()['upToDate']
         while not uptodate and loop < 80:
             time.sleep(15)
-            resp = hub.execute_get(href, custom_headers=custom_headers)
+            resp = governor.call(hub.execute_get, href, custom_headers=custom_headers)
             uptodate = resp.json()['upToDate']
             loop += 1
     except Exception as e:
@@ -561,7 +1955,8 @@ def wait_for_bom_completion(hub, ver):
         return False
 
 
-def wait_for_scans(hub, ver):
+def wait_for_scans(hub, ver, scan_names):
+    # Wait for all code locations in scan_names to complete (or any code location if scan_names is empty)
     links = ver['_meta']['links']
     link = next((item for item in links if item["rel"] == "codelocations"), None)
 
@@ -572,14 +1967,19 @@ def wait_for_scans(hub, ver):
     loop = 0
     while wait and loop < 20:
         custom_headers = {'Accept': 'application/vnd.blackducksoftware.internal-1+json'}
-        resp = hub.execute_get(href, custom_headers=custom_headers)
+        resp = governor.call(hub.execute_get, href, custom_headers=custom_headers)
+        completed = []
         for cl in resp.json()['items']:
             if 'status' in cl:
                 status_list = cl['status']
                 for status in status_list:
                     if status['operationNameCode'] == "ServerScanning":
                         if status['status'] == "COMPLETED":
-                            wait = False
+                            completed.append(cl['name'])
+        if len(scan_names) > 0:
+            wait = not all(name in completed for name in scan_names)
+        else:
+            wait = len(completed) == 0
         if wait:
             time.sleep(15)
             loop += 1
@@ -587,6 +1987,35 @@ def wait_for_scans(hub, ver):
     return not wait
 
 
+def unmap_stale_scans(scan_names):
+    # Unmap code locations of the project version from previous runs which are not part of this upload (for
+    # example the unsharded code location after enabling --upload_shards, or shards above a reduced shard count)
+    global args
+
+    prefix = args.project + "/" + args.version + " yocto/bom"
+    try:
+        hub = governor.call(HubInstance)
+        ver = governor.call(hub.get_project_version_by_name, args.project, args.version)
+        if ver is None:
+            return
+        link = next((item for item in ver['_meta']['links'] if item["rel"] == "codelocations"), None)
+        if link is None:
+            return
+        resp = governor.call(hub.execute_get, link['href'] + "?limit=1000")
+        for cl in resp.json()['items']:
+            if (cl['name'] != prefix and not cl['name'].startswith(prefix + " shard ")) or cl['name'] in scan_names:
+                continue
+            cl['mappedProjectVersion'] = ""
+            result = governor.call(hub.execute_put, cl['_meta']['href'], data=cl)
+            if result.status_code in [200, 202, 204]:
+                print("- Unmapped code location '{}' from previous run".format(cl['name']))
+            else:
+                print("WARNING: Unable to unmap code location '{}' from previous run (status {})".format(
+                    cl['name'], result.status_code))
+    except Exception as e:
+        print("WARNING: Unable to unmap code locations from previous runs - ignored\n" + str(e))
+
+
 def proc_replacefile():
     global args
     global rep_layers, rep_recipes
@@ -608,114 +2037,417 @@ def proc_replacefile():
     return True
 
 
-def check_recipes(kbrecfile):
-    global recipes, recipe_layer
-    global rep_layers, rep_recipes
+KB_COMPACT_FILE = 'kb_yocto_recipes.kb.xz'
+KB_COMPACT_HEADER = '#import_yocto_bm-kb 1'
+# Plain text KB lists loaded on top of the snapshots in the compact file (the older 202101 and 2105 snapshots
+# are only included in the compact file)
+KB_SNAPSHOTS = [
+    ('current', 'kb_yocto_recipes.txt'),
+]
+KB_URL = 'https://raw.github.com/matthewb66/import_yocto_bm/master/data/kb_yocto_recipes.txt'
+KB_TIMEOUT = 30
+KB_RETRIES = 3
+
+
+class KBIndex:
+    # Merged index of KB layer/recipe/version entries from one or more KB snapshots.
+    # Strings are interned, per-recipe entry lists are arrays of entry ids and every entry
+    # carries a bitmask of the snapshots which contain it.
+    __slots__ = ('snapshots', '_entries', '_layers', '_vers', '_masks', '_recipes')
+
+    def __init__(self):
+        self.snapshots = []
+        self._entries = {}
+        self._layers = []
+        self._vers = []
+        self._masks = array('L')
+        self._recipes = {}
+
+    def __len__(self):
+        return len(self._layers)
+
+    def add_snapshot(self, name):
+        if name not in self.snapshots:
+            self.snapshots.append(name)
+        return 1 << self.snapshots.index(name)
+
+    def add_line(self, kline, bit):
+        kline = kline.strip()
+        eid = self._entries.get(kline)
+        if eid is not None:
+            self._masks[eid] |= bit
+            return
+        arr = kline.split('/')
+        if len(arr) != 3:
+            return
+        layer, recipe, ver = [sys.intern(a) for a in arr]
+        eid = len(self._layers)
+        self._entries[kline] = eid
+        self._layers.append(layer)
+        self._vers.append(ver)
+        self._masks.append(bit)
+        if recipe not in self._recipes:
+            self._recipes[recipe] = array('L')
+        self._recipes[recipe].append(eid)
+
+    def add_lines(self, klines, name):
+        bit = self.add_snapshot(name)
+        for kline in klines:
+            self.add_line(kline, bit)
+
+    def add_file(self, f, name):
+        # Add KB file in plain (one layer/recipe/version per line) or compact format
+        first = f.readline()
+        if first.startswith(KB_COMPACT_HEADER):
+            self.add_compact(first, f)
+        else:
+            self.add_lines(itertools.chain([first], f), name)
+
+    def add_compact(self, header, f):
+        # Compact format - header line listing the snapshots, then one line per recipe of space separated
+        # tokens in entry order: '@layer' sets the layer and '=mask' the snapshot mask for the following versions
+        # (versions which are empty or start with '@', '=' or '\\' are escaped with a leading '\\')
+        bits = [self.add_snapshot(name) for name in header.split()[2].split(",")]
+        allmask = (1 << len(bits)) - 1
+        for line in f:
+            tokens = line.split()
+            if len(tokens) < 2:
+                continue
+            recipe = tokens[0]
+            layer = ""
+            bit = sum(bits)
+            for token in tokens[1:]:
+                if token[0] == "@":
+                    layer = token[1:]
+                elif token[0] == "=":
+                    mask = int(token[1:])
+                    bit = sum(bits[i] for i in range(len(bits)) if mask & (1 << i) & allmask)
+                elif token[0] == "\\":
+                    self.add_line(layer + "/" + recipe + "/" + token[1:], bit)
+                else:
+                    self.add_line(layer + "/" + recipe + "/" + token, bit)
+
+    def write_compact(self, f):
+        f.write("{} {}\n".format(KB_COMPACT_HEADER, ",".join(self.snapshots)))
+        allmask = (1 << len(self.snapshots)) - 1
+        for recipe, eids in self._recipes.items():
+            tokens = [recipe]
+            layer = None
+            mask = allmask
+            for eid in eids:
+                if self._layers[eid] != layer:
+                    layer = self._layers[eid]
+                    tokens.append("@" + layer)
+                if self._masks[eid] != mask:
+                    mask = self._masks[eid]
+                    tokens.append("=" + str(mask))
+                ver = self._vers[eid]
+                if ver == "" or ver[0] in "@=\\":
+                    ver = "\\" + ver
+                tokens.append(ver)
+            f.write(" ".join(tokens) + "\n")
+
+    def recipe_table(self):
+        # Dict of recipe: list of (layer, version, mask) in entry order (used to compare indexes)
+        return {recipe: [(self._layers[eid], self._vers[eid], self._masks[eid]) for eid in eids]
+                for recipe, eids in self._recipes.items()}
+
+    def snapshot_mask(self, names=""):
+        # Bitmask for comma-separated snapshot names (all snapshots if not specified)
+        if names == "" or names == "all":
+            return (1 << len(self.snapshots)) - 1
+        mask = 0
+        for name in names.split(","):
+            if name in self.snapshots:
+                mask |= 1 << self.snapshots.index(name)
+        return mask
+
+    def contains(self, comp, mask):
+        eid = self._entries.get(comp)
+        return eid is not None and (self._masks[eid] & mask) != 0
+
+    def recipe_entries(self, recipe, mask):
+        # List of (layer, version) tuples for the recipe within the selected snapshots
+        if recipe not in self._recipes:
+            return []
+        return [(self._layers[eid], self._vers[eid]) for eid in self._recipes[recipe] if self._masks[eid] & mask]
+
+
+def get_cache_dir():
+    global args
+
+    if args.cache_dir != "":
+        cachedir = args.cache_dir
+    else:
+        cachedir = os.path.join(os.path.expanduser("~"), ".cache", "import_yocto_bm")
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    return cachedir
+
+
+def kb_cache_file(url):
+    import hashlib
+
+    return os.path.join(get_cache_dir(), "kb_" + hashlib.sha1(url.encode()).hexdigest()[:16] + ".txt")
+
+
+def read_kb_lines(path):
+    k = open_input(path)
+    klines = k.read().splitlines()
+    k.close()
+    return klines
+
+
+def fetch_kb_url(url):
+    # Return list of KB recipe lines from URL, revalidating the local cached copy with ETag/If-Modified-Since
     import requests
 
-    print("- Checking recipes against Black Duck KB ...")
+    if url.startswith("file://"):
+        import urllib.request
+        import urllib.parse
+        return read_kb_lines(urllib.request.url2pathname(urllib.parse.urlparse(url).path))
+
+    cachefile = kb_cache_file(url)
+    meta = {}
+    headers = {'Accept-Encoding': 'gzip'}
+    if os.path.isfile(cachefile) and os.path.isfile(cachefile + ".json"):
+        m = open(cachefile + ".json", "r")
+        meta = json.load(m)
+        m.close()
+        if 'etag' in meta:
+            headers['If-None-Match'] = meta['etag']
+        if 'last-modified' in meta:
+            headers['If-Modified-Since'] = meta['last-modified']
+
+    r = requests.get(url, headers=headers, timeout=KB_TIMEOUT, stream=True)
+    if r.status_code == 304:
+        print("	KB recipes unchanged - using cached copy")
+        r.close()
+        return read_kb_lines(cachefile)
+    if r.status_code != 200:
+        r.close()
+        raise requests.exceptions.HTTPError("HTTP status {}".format(r.status_code), response=r)
+
+    if r.encoding is None:
+        r.encoding = "utf-8"
+    klines = []
+    c = open(cachefile + ".tmp", "w")
+    try:
+        for kline in r.iter_lines(decode_unicode=True):
+            klines.append(kline)
+            c.write(kline + "\n")
+        c.close()
+        os.replace(cachefile + ".tmp", cachefile)
+    finally:
+        if not c.closed:
+            c.close()
+        if os.path.isfile(cachefile + ".tmp"):
+            os.remove(cachefile + ".tmp")
+
+    meta = {}
+    if 'ETag' in r.headers:
+        meta['etag'] = r.headers['ETag']
+    if 'Last-Modified' in r.headers:
+        meta['last-modified'] = r.headers['Last-Modified']
+    m = open(cachefile + ".json", "w")
+    json.dump(meta, m)
+    m.close()
+    return klines
+
+
+def fetch_kb_recipes(kbindex, name):
+    # Try each KB mirror URL in turn, retrying transient failures - recipes are only added to the index once
+    # completely downloaded, and a previously cached download is used if all mirrors fail
+    global args
+    import requests
+
+    urls = args.kb_url
+    if len(urls) == 0:
+        urls = [KB_URL]
+    for url in urls:
+        print("	Downloading KB recipes from {} ...".format(url))
+        for attempt in range(KB_RETRIES):
+            try:
+                kbindex.add_lines(fetch_kb_url(url), name)
+                return True
+            except requests.exceptions.HTTPError as e:
+                print("	Unable to download KB recipes - " + str(e))
+                if e.response is None or e.response.status_code < 500:
+                    break
+            except (requests.exceptions.RequestException, OSError) as e:
+                print("	Unable to download KB recipes - " + str(e))
+            if attempt < KB_RETRIES - 1:
+                time.sleep(2 ** attempt)
 
+    for url in urls:
+        if url.startswith("file://"):
+            continue
+        try:
+            cachefile = kb_cache_file(url)
+            if os.path.isfile(cachefile):
+                klines = read_kb_lines(cachefile)
+                print("	WARNING: Using previously downloaded KB recipes from {}".format(url))
+                kbindex.add_lines(klines, name)
+                return True
+        except OSError as e:
+            print("	Unable to read cached KB recipes - " + str(e))
+    return False
+
+
+def load_kb_index(kbrecfile):
+    kbindex = KBIndex()
     if kbrecfile != "":
         if not os.path.isfile(kbrecfile):
-            return
+            return None
 
         try:
-            k = open(kbrecfile, "r")
-            klines = k.readlines()
+            k = open_input(kbrecfile)
+            kbindex.add_file(k, os.path.basename(kbrecfile))
             k.close()
         except Exception as e:
-            return
-    else:
-        print("	Downloading KB recipes ...")
-
-        url = 'https://raw.github.com/matthewb66/import_yocto_bm/master/data/kb_yocto_recipes.txt'
-        r = requests.get(url)
+            print("ERROR: Unable to read KB recipe file {}\n".format(kbrecfile) + str(e))
+            return None
+        return kbindex
+
+    datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+    for name, kbfile in [('', KB_COMPACT_FILE)] + KB_SNAPSHOTS:
+        path = os.path.join(datadir, kbfile)
+        if not os.path.isfile(path):
+            continue
+        try:
+            k = open_input(path)
+            kbindex.add_file(k, name)
+            k.close()
+        except Exception as e:
+            print("ERROR: Unable to read KB recipe file {}\n".format(path) + str(e))
+            return None
 
-        if r.status_code != 200:
+    if not fetch_kb_recipes(kbindex, 'current'):
+        if len(kbindex) == 0:
             print(
-                '''Unable to download KB recipe data from Github. Unable to download KB recipe data from Github. 
+                '''Unable to download KB recipe data from Github. 
                 Consider downloading manually and using the --kb_recipe_file option.''')
-            return
-        klines = r.text.split("\n")
+            return None
+        print("	WARNING: Unable to download KB recipe data - using local KB snapshots")
+
+    return kbindex
+
+
+def write_kb_compact(kbrecfile, outfile):
+    # Write KB recipes to xz compressed compact format file
+    import lzma
+
+    print("- Reading KB recipes ...")
+    kbindex = load_kb_index(kbrecfile)
+    if kbindex is None:
+        return False
+    try:
+        o = lzma.open(outfile, "wt", encoding="utf-8", preset=9 | lzma.PRESET_EXTREME)
+        kbindex.write_compact(o)
+        o.close()
+    except Exception as e:
+        print("ERROR: Unable to write compact KB file {}\n".format(outfile) + str(e))
+        return False
+
+    # Check the written file reads back to the same snapshots and entries
+    try:
+        k = open_input(outfile)
+        check = KBIndex()
+        check.add_file(k, "")
+        k.close()
+    except Exception as e:
+        print("ERROR: Unable to read back compact KB file {}\n".format(outfile) + str(e))
+        return False
+    if check.snapshots != kbindex.snapshots or check.recipe_table() != kbindex.recipe_table():
+        print("ERROR: Compact KB file {} does not match the KB recipes read - removed".format(outfile))
+        os.remove(outfile)
+        return False
+    print("- Compact KB file {} written containing {} entries from KB snapshots {}".format(outfile, len(kbindex),
+                                                                                          kbindex.snapshots))
+    return True
+
+
+def check_recipes(kbrecfile):
+    global recipes
+
+    print("- Checking recipes against Black Duck KB ...")
 
     print("	Reading KB recipes ...")
-    kblayers = []
-    kbrecipes = {}
-    kbentries = []
-
-    for kline in klines:
-        arr = kline.rstrip().split('/')
-        if len(arr) == 3:
-            layer = arr[0]
-            recipe = arr[1]
-            ver = arr[2]
-            if layer not in kblayers:
-                kblayers.append(layer)
-
-            if recipe not in kbrecipes.keys():
-                kbrecipes[recipe] = [layer + "/" + ver]
-            elif layer + "/" + ver not in kbrecipes[recipe]:
-                kbrecipes[recipe].append(layer + "/" + ver)
-
-            if kline not in kbentries:
-                kbentries.append(kline)
-
-    keys = ['OK', 'REPLACED', 'REPLACED_NOREVISION', 'REPLACED_NOLAYER+REVISION', 'NOTREPLACED_NOVERSION',
-            'NOTREPLACED_NOLAYER+VERSION', 'MISSING']
+    kbindex = load_kb_index(kbrecfile)
+    if kbindex is None:
+        return
+
+    kbmask = kbindex.snapshot_mask(args.kb_snapshot)
+    if kbmask == 0:
+        print("ERROR: KB snapshot '{}' not available (available snapshots {})".format(args.kb_snapshot,
+                                                                                     kbindex.snapshots))
+        return
+
+    print("	Processed {} recipes from KB snapshots {}".format(len(kbindex), kbindex.snapshots))
+    report = match_recipes(kbindex, kbmask, recipes)
+
+    print("	Checked {} recipes from Yocto project ...".format(len(recipes)))
+    if args.report is not None:
+        try:
+            repfile = open('report.txt', "w")
+            for key in KB_OUTCOMES:
+                for rep in report[key]:
+                    repfile.write(key + ':' + rep + '\n')
+        except Exception as e:
+            return
+        finally:
+            repfile.close()
+            print(' Report file report.txt written containing list of mapped layers/recipes.')
+
+    return
+
+
+KB_OUTCOMES = ['OK', 'REPLACED', 'REPLACED_NOREVISION', 'REPLACED_NOLAYER+REVISION', 'NOTREPLACED_NOVERSION',
+               'NOTREPLACED_NOLAYER+VERSION', 'MISSING']
+
+
+def match_recipes(kbindex, kbmask, recipes, log=print):
+    # Check recipes against the KB index, replacing layers/versions where matches found - returns report
+    # entries by outcome
     report = {}
-    for key in keys:
+    for key in KB_OUTCOMES:
         report[key] = []
 
-    print("	Processed {} recipes from KB".format(len(kbentries)))
-    layer = ''
     comp = ''
-    for recipe in recipes.keys():
-        ver = recipes[recipe]
-
-        if recipe in recipe_layer.keys():
-            layer = recipe_layer[recipe]
-            origcomp = layer + "/" + recipe + "/" + orig_recipes[recipe]
-
-            newlayer_string = layer
-            if recipe in rep_recipes.keys():
-                newrecipever_string = rep_recipes[recipe] + "/" + ver
-            elif recipe + "/" + ver in rep_recipes.keys():
-                newrecipever_string = rep_recipes[recipe + "/" + ver]
-            elif layer + "/" + recipe in rep_recipes.keys():
-                newlayer_string = rep_recipes[layer + "/" + recipe].split("/")[0]
-                slash = rep_recipes[layer + "/" + recipe].find("/") + 1
-                newrecipever_string = rep_recipes[layer + "/" + recipe][slash:]
-            elif layer + "/" + recipe + "/" + ver in rep_recipes.keys():
-                newlayer_string = rep_recipes[layer + "/" + recipe + "/" + ver].split("/")[0]
-                slash = rep_recipes[layer + "/" + recipe + "/" + ver].find("/") + 1
-                newrecipever_string = rep_recipes[layer + "/" + recipe + "/" + ver][slash:]
-            else:
-                newrecipever_string = recipe + "/" + ver
+    for recipe, rec in recipes.items():
+        ver = rec.version
+        layer = rec.layer
+        origcomp = layer + "/" + recipe + "/" + rec.orig_version
+
+        if layer != "":
+            newlayer_string, newrecipever_string = replace_recipe(layer, recipe, ver, layer)
 
             comp = newlayer_string + "/" + newrecipever_string
 
-            if comp in kbentries:
+            if kbindex.contains(comp, kbmask):
                 # Component exists in KB
+                rec.outcome = 'OK'
                 report['OK'].append(comp)
 
                 continue
 
         # No exact match found in KB list
-        if recipe in kbrecipes.keys():
+        kbrecentries = kbindex.recipe_entries(recipe, kbmask)
+        if len(kbrecentries) > 0:
             # recipe exists in KB
             kbrecvers = []
             kbreclayers = []
-            for entry in kbrecipes[recipe]:
-                arr = entry.split("/")
+            for arr in kbrecentries:
                 kbreclayers.append(arr[0])
                 kbrecvers.append(arr[1])
                 if layer != arr[0] and ver == arr[1]:
                     # Recipe and version exist in KB - layer is different
-                    print(
+                    log(
                         '''	- Component {}: Recipe and version exist in KB, but not within the layer '{}' - replaced 
                         with '{}/{}/{}' from KB'''.format(
                             comp, layer, arr[0], recipe, ver))
-                    recipe_layer[recipe] = arr[0]
+                    rec.layer = sys.intern(arr[0])
+                    rec.outcome = 'REPLACED'
                     report['REPLACED'].append("ORIG={} REPLACEMENT={}/{}/{}".format(origcomp, arr[0], recipe, ver))
 
                     break
@@ -731,21 +2463,23 @@ def check_recipes(kbrecfile):
                             if ver_without_rev == kbver_without_rev:
                                 # Found KB version with a different revision
                                 if layer == kbreclayers[kbrecvers.index(kbver)]:
-                                    print(
+                                    log(
                                         '''	- Component {}: Layer, recipe and version exist in KB, but revision does 
                                         not - replaced with '{}/{}/{}' from KB'''.format(
                                             comp, kbreclayers[kbrecvers.index(kbver)], recipe, kbver))
-                                    recipes[recipe] = kbver
+                                    rec.version = kbver
+                                    rec.outcome = 'REPLACED_NOREVISION'
                                     report['REPLACED_NOREVISION'].append("ORIG={} REPLACEMENT={}/{}/{}".format(
                                         origcomp, kbreclayers[kbrecvers.index(kbver)], recipe, kbver))
 
                                 else:
-                                    print(
+                                    log(
                                         '''	- Component {}: Recipe and version exist in KB, but revision and layer do 
                                         not - replaced with '{}/{}/{}' from KB'''.format(
                                             comp, kbreclayers[kbrecvers.index(kbver)], recipe, kbver))
-                                    recipe_layer[recipe] = kbreclayers[kbrecvers.index(kbver)]
-                                    recipes[recipe] = kbver
+                                    rec.layer = sys.intern(kbreclayers[kbrecvers.index(kbver)])
+                                    rec.version = kbver
+                                    rec.outcome = 'REPLACED_NOLAYER+REVISION'
                                     report['REPLACED_NOLAYER+REVISION'].append("ORIG={} REPLACEMENT={}/{}/{}".format(
                                         origcomp, kbreclayers[kbrecvers.index(kbver)], recipe, kbver))
 
@@ -753,43 +2487,371 @@ def check_recipes(kbrecfile):
                     else:
                         if layer == kbreclayers[kbrecvers.index(kbver)]:
                             # Recipe exists in layer within KB, but version does not
-                            print(
+                            log(
                                 '''	- Component {}: Recipe exists in KB within the layer but version does not - 
                                 consider using --repfile with a version replacement (available versions {})'''.format(
                                     comp, kbrecvers))
+                            rec.outcome = 'NOTREPLACED_NOVERSION'
                             report['NOTREPLACED_NOVERSION'].append(
                                 "ORIG={} Check layers/recipes in KB - Available versions={}".format(origcomp, kbrecvers))
 
                             continue
                         else:
                             # Recipe exists within KB, but layer and version do not
-                            print(
+                            log(
                                 '''	- Component {}: Recipe exists in KB but layer and version do not - consider using 
                                 --repfile with a version replacement (available versions {})'''.format(
                                     comp, kbrecvers))
+                            rec.outcome = 'NOTREPLACED_NOLAYER+VERSION'
                             report['NOTREPLACED_NOLAYER+VERSION'].append(
                                 "ORIG={} Check layers/recipes in KB - Available versions={}".format(origcomp,
                                                                     kbrecvers))
                             continue
             continue
 
-        print("	- Component {} missing from KB - will not be mapped in Black Duck project".format(comp))
+        log("	- Component {} missing from KB - will not be mapped in Black Duck project".format(comp))
+        rec.outcome = 'MISSING'
         report['MISSING'].append(comp)
 
-    print("	Checked {} recipes from Yocto project ...".format(len(recipes)))
-    if args.report is not None:
+    return report
+
+
+# NOREVISION - recipes in the KB but not mapped whose revision could not be read (recipeinfo missing next to
+# the manifest)
+KB_GAP_OUTCOMES = ['MISSING', 'NOTREPLACED_NOLAYER+VERSION', 'NOTREPLACED_NOVERSION', 'NOREVISION']
+
+
+def find_gap_manifests(paths):
+    # Return sorted list of license.manifest files (optionally compressed) from files and folders
+    manifests = set()
+    for path in paths:
+        if os.path.isfile(path):
+            manifests.add(os.path.abspath(path))
+            continue
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                if name.startswith("license.manifest"):
+                    manifests.add(os.path.abspath(os.path.join(root, name)))
+    return sorted(manifests)
+
+
+def gap_init(state):
+    # Process pool initializer - KB index, layers and replacements are shared from the parent process
+    global gap_state, rep_recipes
+
+    gap_state = state
+    rep_recipes = state['rep_recipes']
+
+
+def gap_analyse_manifest(manifest):
+    # Check recipes from one manifest against the KB - returns (manifest, list of (outcome, layer, recipe,
+    # version) for recipes not mapped, error)
+    global args, gap_state
+
+    mrecipes = {}
+    try:
+        for package, ver, recipe in open_manifest_records(manifest):
+            if recipe not in mrecipes:
+                mrecipes[recipe] = Recipe(recipe, ver)
+    except Exception as e:
+        return manifest, None, str(e)
+    if len(mrecipes) == 0:
+        return manifest, None, "No recipes found in manifest"
+
+    # Recipeinfo folders are in the licenses folder containing the image manifest folder
+    licdir = os.path.dirname(os.path.dirname(manifest))
+    norevs = set()
+    for recipe, rec in mrecipes.items():
+        if recipe in gap_state['recipe_layers']:
+            rec.layer, rec.version = gap_state['recipe_layers'][recipe]
+        normalise_recipe_version(rec)
+        if args.debug:
+            rec.version += "-r0"
+        else:
+            revs = []
+            try:
+                revs = recipeinfo_revisions(os.path.join(licdir, recipe, "recipeinfo"))
+            except Exception:
+                # Reported as NOREVISION if the recipe is not mapped
+                pass
+            if len(revs) == 0:
+                norevs.add(recipe)
+            for rev in revs:
+                rec.version += "-" + rev
+        rec.orig_version = rec.version
+
+    origs = dict((recipe, rec.layer) for recipe, rec in mrecipes.items())
+    match_recipes(gap_state['kbindex'], gap_state['kbmask'], mrecipes, log=lambda *a: None)
+    for recipe in norevs:
+        if mrecipes[recipe].outcome != 'MISSING' and mrecipes[recipe].outcome in KB_GAP_OUTCOMES + ['NOTCHECKED']:
+            mrecipes[recipe].outcome = 'NOREVISION'
+    gaps = [(rec.outcome, origs[recipe], recipe, rec.orig_version) for recipe, rec in mrecipes.items()
+            if rec.outcome in KB_GAP_OUTCOMES]
+    return manifest, gaps, ""
+
+
+def kb_gap_analysis():
+    # Check recipes from many manifests against the KB in parallel and report the unmapped recipes by frequency
+    global args
+    import multiprocessing
+
+    manifests = find_gap_manifests(args.kb_gap)
+    if len(manifests) == 0:
+        print("ERROR: No license.manifest files found")
+        return False
+
+    if args.replacefile != "":
+        if not proc_replacefile():
+            return False
+
+    print("- Reading KB recipes ...")
+    kbindex = load_kb_index(args.kb_recipe_file)
+    if kbindex is None:
+        return False
+    kbmask = kbindex.snapshot_mask(args.kb_snapshot)
+    if kbmask == 0:
+        print("ERROR: KB snapshot '{}' not available (available snapshots {})".format(args.kb_snapshot,
+                                                                                     kbindex.snapshots))
+        return False
+
+    recipe_layers, found_layers = read_layer_recipes()
+
+    workers = args.kb_gap_workers
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(manifests))
+    print("- Checking {} manifests against KB snapshots {} using {} processes ...".format(len(manifests),
+                                                                                       kbindex.snapshots, workers))
+    state = {'kbindex': kbindex, 'kbmask': kbmask, 'recipe_layers': recipe_layers, 'rep_recipes': rep_recipes}
+
+    # Recipe gaps - (outcome, layer, recipe): [manifest count, set of versions]
+    gaps = {}
+    checked = 0
+    norev_manifests = 0
+    pool = multiprocessing.Pool(workers, initializer=gap_init, initargs=(state,))
+    try:
+        for manifest, results, error in pool.imap_unordered(gap_analyse_manifest, manifests):
+            if results is None:
+                print("	WARNING: Unable to read manifest {} - skipped\n	".format(manifest) + error)
+                continue
+            checked += 1
+            if any(result[0] == 'NOREVISION' for result in results):
+                norev_manifests += 1
+            for outcome, layer, recipe, ver in results:
+                gap = gaps.setdefault((outcome, layer, recipe), [0, set()])
+                gap[0] += 1
+                gap[1].add(ver)
+    finally:
+        pool.close()
+        pool.join()
+
+    lines = ["KB gap analysis of {} manifests (KB snapshots {})".format(checked, args.kb_snapshot or "all")]
+    if norev_manifests > 0:
+        lines.append("{} manifests with recipes without recipeinfo revisions (licenses folder not next to the "
+                     "manifest folder) - see NOREVISION".format(norev_manifests))
+    for outcome in KB_GAP_OUTCOMES:
+        entries = sorted([(count, layer, recipe, vers) for (o, layer, recipe), (count, vers) in gaps.items()
+                          if o == outcome], key=lambda e: (-e[0], e[1], e[2]))
+        lines.append("")
+        lines.append("{}: {} recipes".format(outcome, len(entries)))
+        for count, layer, recipe, vers in entries:
+            line = "    {:>5}  {}/{} versions={}".format(count, layer, recipe, sorted(vers))
+            if outcome != 'MISSING':
+                line += " KB={}".format(sorted(set(kbver for kblayer, kbver in
+                                                   kbindex.recipe_entries(recipe, kbmask))))
+            lines.append(line)
+
+    if args.kb_gap_output != "":
         try:
-            repfile = open('report.txt', "w")
-            for key in keys:
-                for rep in report[key]:
-                    repfile.write(key + ':' + rep + '\n')
+            o = open(args.kb_gap_output, "w")
+            o.write("\n".join(lines) + "\n")
+            o.close()
         except Exception as e:
-            return
-        finally:
-            repfile.close()
-            print(' Report file report.txt written containing list of mapped layers/recipes.')
+            print("ERROR: Unable to write KB gap report file {}\n".format(args.kb_gap_output) + str(e))
+            return False
+        print("- KB gap report written to {} ({} recipes)".format(args.kb_gap_output, len(gaps)))
+    else:
+        print("")
+        print("\n".join(lines))
+    return True
 
-    return
+
+class INotify:
+    # Minimal inotify wrapper (Linux) used by watch mode
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+
+    def __init__(self, folders):
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        for folder in folders:
+            if self.libc.inotify_add_watch(self.fd, folder.encode(), mask) < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed for {}".format(folder))
+
+    def read(self, timeout):
+        # Return list of file names with events within timeout seconds
+        import select
+        import struct
+
+        names = []
+        if len(select.select([self.fd], [], [], timeout)[0]) == 0:
+            return names
+        data = os.read(self.fd, 65536)
+        pos = 0
+        while pos + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, pos)
+            names.append(data[pos + 16:pos + 16 + length].rstrip(b"\0").decode("utf-8", "replace"))
+            pos += 16 + length
+        return names
+
+
+def watch_import_cmd(manifest, cvefile, timestamp):
+    # Command line to import one image build, passing through options which are not defaults
+    global args
+
+    version = args.version.replace("{timestamp}", timestamp).replace("{image}", args.target + "-" + args.arch)
+    cmd = [sys.executable, os.path.abspath(__file__), "-p", args.project, "-v", version,
+           "-y", args.yocto_build_folder, "-t", args.target, "--arch", args.arch, "-m", manifest]
+    if cvefile != "":
+        cmd += ["--cve_check_file", cvefile]
+    else:
+        # Do not let the import locate the cve_check file of a different build
+        cmd.append("--no_cve_check")
+    for opt in ['replacefile', 'buildconf', 'localconf', 'kb_recipe_file', 'kb_snapshot', 'cache_dir', 'journal',
+                'bdsa_cache', 'bdsa_cache_ttl', 'upload_shards', 'report', 'state_db', 'show_recipes_file']:
+        if getattr(args, opt) != parser.get_default(opt):
+            cmd += ["--" + opt, str(getattr(args, opt))]
+    for opt in ['no_kb_check', 'resume', 'no_state', 'bdio2']:
+        if getattr(args, opt):
+            cmd.append("--" + opt)
+    # Share the API request limit between the concurrent imports
+    cmd += ["--api_max_concurrency", str(max(1, args.api_max_concurrency // args.watch_workers)),
+            "--api_latency_target", str(args.api_latency_target)]
+    for url in args.kb_url:
+        cmd += ["--kb_url", url]
+    return cmd
+
+
+def watch_import(manifest, cvefile, timestamp):
+    import shlex
+
+    cmd = watch_import_cmd(manifest, cvefile, timestamp)
+    print("- Importing build {} ...".format(timestamp))
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    for line in proc.stdout.splitlines():
+        print("	[{}] {}".format(timestamp, line))
+    if proc.returncode != 0:
+        print("ERROR: Import of build {} failed (exit code {}) - it will not be retried while watching, rerun the "
+              "import manually:\n	{}".format(timestamp, proc.returncode, " ".join(shlex.quote(arg) for arg in cmd)))
+    else:
+        print("- Import of build {} completed".format(timestamp))
+
+
+def watch_builds():
+    # Watch the deploy folder and import each new image build once its files stop changing
+    global args, deploy_dir
+    from concurrent.futures import ThreadPoolExecutor
+
+    image = args.target + "-" + args.arch
+    licdir = os.path.join(deploy_dir, "licenses")
+    imgdir = os.path.join(deploy_dir, "images", args.arch)
+    for folder in [licdir, imgdir]:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    if args.show_recipes_file == "":
+        # Run bitbake-layers once - concurrent imports would contend for the build folder lock
+        print("Identifying layers for recipes ...")
+        args.show_recipes_file = os.path.join(get_cache_dir(), "show_recipes_" + image + ".txt")
+        try:
+            lines = bitbake_show_recipes()
+            r = open(args.show_recipes_file, "w")
+            r.write("\n".join(lines) + "\n")
+            r.close()
+        except Exception as e:
+            print("ERROR: Unable to identify layers using bitbake-layers\n" + str(e))
+            sys.exit(3)
+
+    def scan_builds():
+        index = index_deploy_dir(deploy_dir)
+        machines[:] = index['machines']
+        stamps = set(deploy_image_suffix(entry[1], image, machines)
+                     for entry in index['manifests'] + index['cvefiles'])
+        stamps.discard("")
+        return stamps
+
+    def event_build(name):
+        # Build suffix for an image manifest folder or cve_check file event ("" if not for a build of the image)
+        if name.endswith(".rootfs.cve"):
+            return deploy_image_suffix(name[:-len(".rootfs.cve")], image, machines)
+        if os.path.isdir(os.path.join(licdir, name)):
+            return deploy_image_suffix(name, image, machines)
+        return ""
+
+    machines = []
+    seen = scan_builds()
+    try:
+        watcher = INotify([licdir, imgdir])
+        print("Watching {} and {} for new {} builds (inotify) ...".format(licdir, imgdir, image))
+    except Exception as e:
+        watcher = None
+        print("WARNING: inotify not available - " + str(e))
+        print("Watching {} and {} for new {} builds (polling every {} seconds) ...".format(
+            licdir, imgdir, image, WATCH_POLL_INTERVAL))
+
+    # Pending builds - timestamp: [time first seen, time of last change, manifest exists]
+    pending = {}
+    executor = ThreadPoolExecutor(max_workers=args.watch_workers)
+    try:
+        while True:
+            if watcher is not None:
+                for name in watcher.read(1):
+                    stamp = event_build(name)
+                    if stamp != "" and stamp not in seen:
+                        pending.setdefault(stamp, [time.time(), 0, False])[1] = time.time()
+            else:
+                time.sleep(WATCH_POLL_INTERVAL)
+                for stamp in scan_builds() - seen:
+                    if stamp not in pending:
+                        pending[stamp] = [time.time(), time.time(), False]
+
+            now = time.time()
+            for stamp, state in list(pending.items()):
+                if now - state[1] < WATCH_DEBOUNCE:
+                    continue
+                manifest = os.path.join(licdir, image + "-" + stamp, "license.manifest")
+                if not state[2]:
+                    if os.path.isfile(manifest):
+                        # Wait for a further debounce period in case the manifest is still being written
+                        state[1] = now
+                        state[2] = True
+                    elif now - state[0] > WATCH_MANIFEST_TIMEOUT:
+                        print("WARNING: No license.manifest for build {} - ignored".format(stamp))
+                        del pending[stamp]
+                        seen.add(stamp)
+                    continue
+                cvefile = ""
+                if not args.no_cve_check:
+                    cvefile = os.path.join(imgdir, image + "-" + stamp + ".rootfs.cve")
+                    if not os.path.isfile(cvefile):
+                        print("WARNING: No cve_check file for build {} - CVE patch updates will be skipped".format(
+                            stamp))
+                        cvefile = ""
+                del pending[stamp]
+                seen.add(stamp)
+                executor.submit(watch_import, manifest, cvefile, stamp)
+    except KeyboardInterrupt:
+        print("Stopping watch - waiting for running imports to complete ...")
+    finally:
+        executor.shutdown(wait=True)
 
 
 parser = argparse.ArgumentParser(description='Import Yocto build manifest to BD project version',
@@ -810,6 +2872,17 @@ parser.add_argument("-t", "--target", help="Yocto target (default core-poky-sato
 parser.add_argument("-m", "--manifest",
                     help="Input build license.manifest file (if not specified will be determined from conf files)",
                     default="")
+parser.add_argument("--buildhistory",
+                    help="Buildhistory folder to read recipes, versions and layers from (instead of license.manifest)",
+                    default="")
+parser.add_argument("--bblayers",
+                    help='''Layers config file used to map buildhistory layer collections to layer folders (if not 
+                    specified conf/bblayers.conf in the Yocto build folder will be used)''',
+                    default="")
+parser.add_argument("--show_recipes_file",
+                    help='''File containing 'bitbake-layers show-recipes' output to identify recipe layers (instead of 
+                    running bitbake-layers)''',
+                    default="")
 parser.add_argument("-b", "--buildconf",
                     help="Build config file (if not specified poky/meta/conf/bitbake.conf will be used)", default="")
 parser.add_argument("-l", "--localconf",
@@ -824,9 +2897,68 @@ parser.add_argument("--cve_check_file",
                     help="CVE check output file (if not specified will be determined from conf files)", default="")
 parser.add_argument("--no_kb_check", help="Do not check recipes against KB", action='store_true')
 parser.add_argument("--kb_recipe_file", help="KB recipe file local copy", default="")
+parser.add_argument("--kb_url",
+                    help="KB recipe download URL or mirror (http://, https:// or file:// - can be specified multiple times)",
+                    action='append', default=[])
+parser.add_argument("--cache_dir", help="Folder for cached data (default ~/.cache/import_yocto_bm)", default="")
+parser.add_argument("--kb_compact_output",
+                    help="Write the KB recipes (from --kb_recipe_file or the KB snapshots and download) to a compressed compact KB file and exit",
+                    default="")
+parser.add_argument("--kb_gap",
+                    help="Check recipes from license.manifest file or all license.manifest files in folder against the KB and report unmapped recipes (can be specified multiple times)",
+                    action='append', default=[])
+parser.add_argument("--kb_gap_workers",
+                    help="Number of processes used for KB gap analysis (default number of CPUs)", type=int, default=0)
+parser.add_argument("--kb_gap_output", help="Output file for KB gap report (default print report)", default="")
+parser.add_argument("--kb_snapshot",
+                    help="KB snapshot(s) to check recipes against (comma-separated list from 202101,2105,current - default all)",
+                    default="")
 parser.add_argument("--report",
                     help="Output report.txt file of matched recipes",
                     default="")
+parser.add_argument("--bdsa_cache",
+                    help="BDSA to CVE mapping cache file shared across runs (default bdsa_cves.db in cache folder)",
+                    default="")
+parser.add_argument("--bdsa_cache_ttl", help="Expiry time for BDSA to CVE cache entries in days (default 30)",
+                    type=float, default=30)
+parser.add_argument("--bdio2",
+                    help="Generate BDIO 2 format (zip of JSON-LD entries) instead of BDIO 1 JSON for output or upload",
+                    action='store_true')
+parser.add_argument("--upload_shards",
+                    help="Split the BOM by layer into up to this number of code locations uploaded concurrently",
+                    type=int, default=1)
+parser.add_argument("--journal",
+                    help="Journal file recording the BOM processed for each project version for --resume (default remediation_journal.jsonl in cache folder)",
+                    default="")
+parser.add_argument("--resume",
+                    help="Skip upload and waiting for server scan/BOM completion if the BOM is unchanged since the previous run",
+                    action='store_true')
+parser.add_argument("--watch",
+                    help="Watch the deploy folder and import each new image build as it completes (use {timestamp} in the version name to create a version per build)",
+                    action='store_true')
+parser.add_argument("--watch_workers", help="Number of concurrent imports in watch mode (default 2)", type=int,
+                    default=2)
+parser.add_argument("--state_db",
+                    help="State store recording recipes, KB mappings, components and patched CVEs for each run (default state.db in cache folder)",
+                    default="")
+parser.add_argument("--no_state", help="Do not record or use the state store", action='store_true')
+parser.add_argument("--state_report",
+                    help="Report KB mappings and patched CVEs recorded in the state store for the project version (no server access)",
+                    action='store_true')
+parser.add_argument("--state_diff",
+                    help="Report differences recorded in the state store between the specified version and the project version",
+                    default="")
+parser.add_argument("--fleet",
+                    help="JSON file listing project, version and cve_check_file for many existing project versions to apply patched CVEs to concurrently",
+                    default="")
+parser.add_argument("--fleet_workers", help="Number of project versions processed concurrently in fleet mode (default 4)",
+                    type=int, default=4)
+parser.add_argument("--api_max_concurrency",
+                    help="Maximum number of concurrent Black Duck API requests (default 8 - shared between the concurrent imports in watch mode)",
+                    type=int, default=8)
+parser.add_argument("--api_latency_target",
+                    help="API response time in seconds above which request concurrency is reduced (default 10)",
+                    type=float, default=10)
 parser.add_argument("--debug", help="Debug mode (requires DEBUG_bblayers.txt file for show-recipes output)", action='store_true')
 
 args = parser.parse_args()
@@ -839,16 +2971,22 @@ proj = args.project
 ver = args.version
 comps_layers = []
 comps_recipes = []
-packages = []
+packages = set()
 recipes = {}
-orig_recipes = {}
-recipe_layer = {}
 layers = []
-proj_rel = []
 rep_layers = {}
 rep_recipes = {}
 do_upload = True
 licdir = ''
+scan_names = []
+deploy_index = None
+deploy_dir = ''
+governor = HubGovernor(args.api_max_concurrency, args.api_latency_target)
+journal = {'project': args.project, 'version': args.version, 'bom': ""}
+journal_lock = threading.Lock()
+bdsa_cves = {}
+bdsa_lock = threading.Lock()
+gap_state = None
 
 
 def main():
@@ -860,14 +2998,12 @@ def main():
     global comps_recipes
     global packages
     global recipes
-    global comps_recipes
-    global recipe_layer
     global layers
-    global proj_rel
-    global comps_layers
     global rep_layers
-    global rep_recipe
+    global rep_recipes
     global do_upload
+    global scan_names
+    global journal
 
     print("Yocto build manifest import into Black Duck Utility v1.12")
     print("---------------------------------------------------------\n")
@@ -875,7 +3011,44 @@ def main():
     if (not check_args()) or (not check_env()) or (not find_files()):
         sys.exit(1)
 
-    if args.manifest == "":
+    if args.watch:
+        watch_builds()
+        return
+
+    if args.kb_compact_output != "":
+        if not write_kb_compact(args.kb_recipe_file, args.kb_compact_output):
+            sys.exit(3)
+        return
+
+    if len(args.kb_gap) > 0:
+        if not kb_gap_analysis():
+            sys.exit(3)
+        print("Done")
+        return
+
+    if args.state_report or args.state_diff != "":
+        try:
+            if args.state_report and not state_report():
+                sys.exit(3)
+            if args.state_diff != "" and not state_diff(args.state_diff):
+                sys.exit(3)
+        except Exception as e:
+            print("ERROR: Unable to read state store\n" + str(e))
+            sys.exit(3)
+        return
+
+    if args.fleet != "":
+        print("Processing fleet file '{}'".format(args.fleet))
+        ok = fleet_cve_check()
+        if governor.requests > 0:
+            print("\nRun metrics:")
+            governor.print_metrics()
+        if not ok:
+            sys.exit(3)
+        print("Done")
+        return
+
+    if args.manifest == "" and args.buildhistory == "":
         if not check_yocto_build_folder():
             sys.exit(1)
         elif os.path.isabs(args.yocto_build_folder):
@@ -885,155 +3058,143 @@ def main():
                                                                                      os.path.abspath(
                                                                                          args.yocto_build_folder)))
 
-    u = uuid.uuid1()
-
     if args.replacefile != "":
         if not proc_replacefile():
             sys.exit(3)
 
-    if not args.cve_check_only:
-        try:
-            i = open(args.manifest, "r")
-        except Exception as e:
-            print('ERROR: Unable to open input manifest file {}\n'.format(args.manifest) + str(e))
-            sys.exit(3)
+    digest = ""
+    resume_bom = False
+    if do_upload and args.resume and not args.cve_check_only:
+        journal = load_journal(args.project, args.version)
 
-        try:
-            liclines = i.readlines()
-            i.close()
-        except Exception as e:
-            print('ERROR: Unable to read license.manifest file {} \n'.format(args.manifest) + str(e))
-            sys.exit(3)
+    if not args.cve_check_only:
+        if args.buildhistory != "":
+            print("\nProcessing Bitbake project:")
+            if not proc_buildhistory(args.buildhistory):
+                sys.exit(3)
+        else:
+            try:
+                records = open_manifest_records(args.manifest)
+            except Exception as e:
+                print('ERROR: Unable to open input manifest file {}\n'.format(args.manifest) + str(e))
+                sys.exit(3)
 
-        print("\nProcessing Bitbake project:")
-        if not proc_license_manifest(liclines):
-            sys.exit(3)
-        proc_layers_in_recipes()
+            print("\nProcessing Bitbake project:")
+            try:
+                if not proc_license_manifest(records):
+                    sys.exit(3)
+            except (OSError, EOFError) as e:
+                print('ERROR: Unable to read license.manifest file {} \n'.format(args.manifest) + str(e))
+                sys.exit(3)
+            proc_layers_in_recipes()
         proc_recipe_revisions()
         if not args.no_kb_check:
             check_recipes(args.kb_recipe_file)
-        proc_layers()
         proc_recipes()
+        proc_layers()
 
-        # proj_rel is for the project relationship (project to layers)
-
-        mytime = datetime.datetime.now()
-        bdio_header = {
-            "specVersion": "1.1.0",
-            "spdx:name": args.project + "/" + args.version + " yocto/bom",
-            "creationInfo": {
-                "spdx:creator": [
-                    "Tool: Detect-6.3.0",
-                    "Tool: IntegrationBdio-21.0.1"
-                ],
-                "spdx:created": mytime.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-            },
-            "@id": "uuid:" + str(u),
-            "@type": "BillOfMaterials",
-            "relationship": []
-        }
-
-        bdio_project = {
-            "name": args.project,
-            "revision": args.version,
-            "@id": "http:yocto/" + args.project + "/" + args.version,
-            "@type": "Project",
-            "externalIdentifier": {
-                "externalSystemTypeId": "@yocto",
-                "externalId": "yocto/" + args.project + "/" + args.version,
-                "externalIdMetaData": {
-                    "forge": {
-                        "name": "yocto",
-                        "separator": ":",
-                        "usePreferredNamespaceAlias": True
-                    },
-                    "pieces": [
-                        args.project,
-                        args.version
-                    ],
-                    "prefix": ""
-                }
-            },
-            "relationship": proj_rel
-        }
-
-        bdio = [bdio_header, bdio_project, comps_layers, comps_recipes]
-        if not write_bdio(bdio):
-            sys.exit(3)
-
-        if do_upload:
+        if args.upload_shards > 1:
+            shards = shard_layers(args.upload_shards)
+        else:
+            shards = [(comps_layers, comps_recipes)]
+
+        bdios = []
+        for num, (shard_layers_list, shard_recipes_list) in enumerate(shards):
+            scan_name = args.project + "/" + args.version + " yocto/bom"
+            outfile = args.output_json
+            if len(shards) > 1:
+                scan_name += " shard {}".format(num + 1)
+                if outfile != "":
+                    base, ext = os.path.splitext(outfile)
+                    outfile = "{}_{}{}".format(base, num + 1, ext)
+
+            bdio = create_bdio(scan_name, shard_layers_list, shard_recipes_list)
+            if outfile != "":
+                if write_bdio(bdio, outfile) == "":
+                    sys.exit(3)
+            else:
+                bdios.append(bdio)
+            scan_names.append(scan_name)
+
+        digest = bom_digest(shards)
+        state_record_run(digest)
+        if args.resume and journal['bom'] == digest:
+            resume_bom = True
+            print("\nBOM unchanged since previous run - skipping upload (--resume)")
+        elif do_upload:
             print("\nUploading scan to Black Duck server ...")
-            if upload_json(args.output_json):
+            if upload_shards(bdios):
                 print("Scan file uploaded successfully\nBlack Duck project '{}/{}' created.".format(args.project,
                                                                                                     args.version))
+                unmap_stale_scans(scan_names)
             else:
                 print("ERROR: Unable to upload scan file")
                 sys.exit(3)
 
     if args.cve_check_file != "" and not args.no_cve_check:
-        hub = HubInstance()
-
         print("\nProcessing CVEs ...")
 
+        print("- Loading CVEs from cve_check log ...")
+
+        patched = read_cve_check_file(args.cve_check_file)
+        if patched is None:
+            sys.exit(3)
+
+        patched_vulns = [cve for (package, cve) in patched]
+        cves_in_bm = len([package for (package, cve) in patched if package in packages])
+
+        print("      {} total patched CVEs identified".format(len(patched_vulns)))
         if not args.cve_check_only:
+            print(
+                "      {} Patched CVEs within packages in build manifest (including potentially mismatched CVEs which should be ignored)".format(
+                    cves_in_bm))
+
+    if args.cve_check_file != "" and not args.no_cve_check and resume_bom and \
+            state_cves_checked(args.project, args.version, patched_vulns, digest):
+        print("- All patched CVEs already processed for unchanged BOM (from state store) - skipping")
+    elif args.cve_check_file != "" and not args.no_cve_check:
+        hub = governor.call(HubInstance)
+
+        if not args.cve_check_only and not resume_bom:
             print("Waiting for Black Duck server scan completion before continuing ...")
             # Need to wait for scan to process into queue - sleep 15
             time.sleep(15)
 
         try:
             print("- Reading Black Duck project ...")
-            ver = hub.get_project_version_by_name(args.project, args.version)
+            ver = governor.call(hub.get_project_version_by_name, args.project, args.version)
         except Exception as e:
             print("ERROR: Unable to get project version from API\n" + str(e))
             sys.exit(3)
 
-        if not wait_for_scans(hub, ver):
-            print("ERROR: Unable to determine scan status")
-            sys.exit(3)
+        if resume_bom:
+            print("- Skipping wait for scan and BOM completion (--resume)")
+        else:
+            if not wait_for_scans(hub, ver, scan_names):
+                print("ERROR: Unable to determine scan status")
+                sys.exit(3)
 
-        if not wait_for_bom_completion(hub, ver):
-            print("ERROR: Unable to determine BOM status")
-            sys.exit(3)
+            if not wait_for_bom_completion(hub, ver):
+                print("ERROR: Unable to determine BOM status")
+                sys.exit(3)
 
-        print("- Loading CVEs from cve_check log ...")
+            if digest != "":
+                # Only record BOMs generated by this run (--cve_check_only has no digest)
+                journal_append(journal, {'type': 'bom', 'digest': digest})
 
-        try:
-            cvefile = open(args.cve_check_file, "r")
-            cvelines = cvefile.readlines()
-            cvefile.close()
-        except Exception as e:
-            print("ERROR: Unable to open CVE check output file\n" + str(e))
-            sys.exit(3)
+        if args.cve_check_only:
+            # The BOM may have been changed by scans from other runs - check the server's last scan date
+            digest = scan_bom_marker(ver)
+            resume_bom = args.resume
 
-        patched_vulns = []
-        pkgvuln = {}
-        cves_in_bm = 0
-        for line in cvelines:
-            arr = line.split(":")
-            if len(arr) > 1:
-                key = arr[0]
-                value = arr[1].strip()
-                if key == "PACKAGE NAME":
-                    pkgvuln['package'] = value
-                elif key == "PACKAGE VERSION":
-                    pkgvuln['version'] = value
-                elif key == "CVE":
-                    pkgvuln['CVE'] = value
-                elif key == "CVE STATUS":
-                    pkgvuln['status'] = value
-                    if pkgvuln['status'] == "Patched":
-                        patched_vulns.append(pkgvuln['CVE'])
-                        if pkgvuln['package'] in packages:
-                            cves_in_bm += 1
-                    pkgvuln = {}
+        if resume_bom and state_cves_checked(args.project, args.version, patched_vulns, digest):
+            print("- All patched CVEs already processed for unchanged BOM (from state store) - skipping")
+        elif len(patched_vulns) > 0:
+            process_patched_cves(hub, ver, patched_vulns, args.project, args.version, digest)
 
-        print("      {} total patched CVEs identified".format(len(patched_vulns)))
-        if not args.cve_check_only:
-            print(
-                "      {} Patched CVEs within packages in build manifest (including potentially mismatched CVEs which should be ignored)".format(
-                    cves_in_bm))
-        if len(patched_vulns) > 0:
-            process_patched_cves(hub, ver, patched_vulns)
+    if governor.requests > 0:
+        print("\nRun metrics:")
+        governor.print_metrics()
     print("Done")
 
 